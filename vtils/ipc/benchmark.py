@@ -0,0 +1,327 @@
+DESC = """Benchmark of the ways vtils moves arrays between processes
+
+A producer process streams payloads of each size to a consumer (this process)
+over every transport, and reports one-way latency percentiles (p50/p99/p999,
+payloads are stamped with the send time) and throughput:
+    - latency:    payloads paced at --interval, the consumer waits for each
+    - throughput: payloads sent back to back, received / elapsed time
+Latest value transports (mp_array, shm*, triple) may skip payloads when the
+consumer is slower; they count as skipped, not lost. Back to back, their
+consumer only sees a few of the overwritten payloads, so their throughput
+is the producer's write rate instead ("throughput_of": "writes").
+
+Examples:
+    python -m vtils.ipc.benchmark --save ipc.json
+    python -m vtils.ipc.benchmark -t shm_wait -t udp -s 64 -s 65536
+    python -m vtils.ipc.benchmark -t udp -t tcp -t unix
+"""
+
+import json
+import multiprocessing
+import os
+import platform
+import tempfile
+import time
+
+import click
+import numpy as np
+
+from vtils.ipc.ring_buffer import shared_ring_buffer
+from vtils.ipc.shared_memory import shared_memory_array, shared_triple_buffer
+from vtils.sockets.array_socket import ArraySocketReceiver, ArraySocketSender
+from vtils.sockets.array_stream import MAX_DATAGRAM, ArrayReceiver, ArraySender
+
+PAYLOAD_SIZES = (64, 1024, 16384, 262144, 4194304)  # bytes
+_STOP = -1.0  # sequence number of the last payload
+# Pollers yield the cpu between polls, so that they don't starve the producer when cores are scarce
+_yield = getattr(os, "sched_yield", lambda: time.sleep(0))
+
+
+class _mp_array:
+    """ multiprocessing.Array('d') with its lock, as used by plotting/srv.py """
+    latest_value = True
+
+    def __init__(self, nbytes, name):
+        self.handle = self.array = multiprocessing.Array('d', nbytes // 8)
+        self.view = np.frombuffer(self.array.get_obj())
+
+    @staticmethod
+    def sender(handle, nbytes):
+        view = np.frombuffer(handle.get_obj())
+        lock = handle.get_lock()
+
+        def send(payload):
+            with lock:
+                view[:] = payload
+        return send
+
+    def recv(self, out, timeout):
+        # no change signal: poll the sequence number, copy under the lock
+        while True:
+            if self.view[1] != out[1]:
+                with self.array.get_lock():
+                    out[:] = self.view
+                return True
+            if time.perf_counter() > timeout:
+                return False
+            _yield()
+
+    def close(self):
+        pass
+
+
+class _shm:
+    """ shared_memory_array in consistent mode, consumer polls """
+    latest_value = True
+    wait = False
+
+    def __init__(self, nbytes, name):
+        self.handle = name
+        self.memory = shared_memory_array(name, init_array=np.zeros(nbytes // 8), consistent=True)
+        self.seen_seq = self.memory.seq
+
+    @staticmethod
+    def sender(handle, nbytes):
+        memory = shared_memory_array.attach(handle)
+        return memory.write
+
+    def recv(self, out, timeout):
+        while True:
+            if self.wait:
+                self.memory.wait_for_update(max(0.0, timeout - time.perf_counter()))
+            seq = self.memory.seq
+            if seq != self.seen_seq:
+                self.seen_seq = seq
+                self.memory.read(out=out)
+                return True
+            if time.perf_counter() > timeout:
+                return False
+            if not self.wait:
+                _yield()
+
+    def close(self):
+        self.memory.close_link()
+        self.memory.delete_memory()
+
+
+class _shm_wait(_shm):
+    """ shared_memory_array in consistent mode, consumer blocks in wait_for_update() """
+    wait = True
+
+
+class _triple:
+    """ shared_triple_buffer, consumer blocks in wait_for_update() and copies the latest frame """
+    latest_value = True
+
+    def __init__(self, nbytes, name):
+        self.handle = name
+        self.frames = shared_triple_buffer(name, init_array=np.zeros(nbytes // 8))
+
+    @staticmethod
+    def sender(handle, nbytes):
+        frames = shared_triple_buffer(handle)
+        return frames.write
+
+    def recv(self, out, timeout):
+        while True:
+            self.frames.wait_for_update(max(0.0, timeout - time.perf_counter()))
+            frame = self.frames.latest()
+            if frame is not None and frame[1] != out[1]:
+                self.frames.read(out=out)
+                return True
+            if time.perf_counter() > timeout:
+                return False
+
+    def close(self):
+        self.frames.close_link()
+        self.frames.delete_memory()
+
+
+class _ring:
+    """ shared_ring_buffer, consumer polls. Lossless unless overrun """
+    def __init__(self, nbytes, name):
+        self.handle = name
+        capacity = int(np.clip((64 << 20) // nbytes, 8, 4096))
+        self.ring = shared_ring_buffer(name, dtype=np.float64, capacity=capacity, record_shape=(nbytes // 8,))
+
+    @staticmethod
+    def sender(handle, nbytes):
+        ring = shared_ring_buffer(handle)
+        return ring.push
+
+    def recv(self, out, timeout):
+        while True:
+            record = self.ring.pop()
+            if record is not None:
+                out[:] = record
+                return True
+            if time.perf_counter() > timeout:
+                return False
+            _yield()
+
+    def close(self):
+        self.ring.close_link()
+        self.ring.delete_memory()
+
+
+class _udp:
+    """ UDP over loopback with vtils.sockets.array_stream. Payloads over a datagram are fragmented """
+    def __init__(self, nbytes, name):
+        self.receiver = ArrayReceiver(("127.0.0.1", 0), max_nbytes=nbytes, rcvbuf=max(4 << 20, 4 * nbytes))
+        self.handle = self.receiver.address
+
+    @staticmethod
+    def sender(handle, nbytes):
+        return ArraySender(handle, datagram_nbytes=MAX_DATAGRAM).send
+
+    def recv(self, out, timeout):
+        return self.receiver.recv(out=out, timeout=max(1e-6, timeout - time.perf_counter())) is not None
+
+    def close(self):
+        self.receiver.close()
+
+
+class _tcp:
+    """ TCP over loopback with vtils.sockets.array_socket (TCP_NODELAY) """
+    reliable = True
+
+    def __init__(self, nbytes, name):
+        self.receiver = ArraySocketReceiver(self._address(name), max_nbytes=nbytes)
+        self.handle = self.receiver.address
+
+    @staticmethod
+    def _address(name):
+        return ("127.0.0.1", 0)
+
+    @staticmethod
+    def sender(handle, nbytes):
+        return ArraySocketSender(handle).send
+
+    def recv(self, out, timeout):
+        return self.receiver.recv(out=out, timeout=max(1e-6, timeout - time.perf_counter())) is not None
+
+    def close(self):
+        self.receiver.close()
+
+
+class _unix(_tcp):
+    """ Unix domain socket with vtils.sockets.array_socket """
+    @staticmethod
+    def _address(name):
+        return os.path.join(tempfile.gettempdir(), name + ".sock")
+
+
+TRANSPORTS = {
+    "mp_array": _mp_array,
+    "shm": _shm,
+    "shm_wait": _shm_wait,
+    "triple": _triple,
+    "ring": _ring,
+    "udp": _udp,
+    "tcp": _tcp,
+    "unix": _unix,
+}
+
+
+def _producer(transport, handle, nbytes, n_messages, interval, write_rate):
+    send = transport.sender(handle, nbytes)
+    payload = np.zeros(nbytes // 8)
+    time.sleep(0.1)  # let the consumer get ready
+    t_next = t_start = time.perf_counter()
+    for i in range(n_messages):
+        t_next += interval
+        while time.perf_counter() < t_next:  # spin: sleep() is too coarse for us intervals
+            _yield()
+        payload[1] = i + 1
+        payload[0] = time.perf_counter()  # [0]: send time, [1]: sequence number
+        send(payload)
+    write_rate.value = n_messages / (time.perf_counter() - t_start)
+    payload[1] = _STOP
+    # lossy transports may drop a few, reliable ones would block once the consumer stops reading
+    for _ in range(1 if getattr(transport, "reliable", False) else 10):
+        time.sleep(0.01)
+        send(payload)
+
+
+def measure(name, nbytes, n_messages=2000, interval=1e-3, timeout=1.0):
+    """ Stream n_messages payloads of nbytes, every interval (0: back to back). Returns a result dict """
+    transport = TRANSPORTS[name]
+    if nbytes > getattr(transport, "max_nbytes", np.inf):
+        return {"skipped": f"payload over {transport.max_nbytes} bytes"}
+    consumer = transport(nbytes, f"vtils_ipc_bench_{name}")
+    write_rate = multiprocessing.Value('d', np.nan)
+    producer = multiprocessing.Process(target=_producer, args=(transport, consumer.handle, nbytes, n_messages, interval, write_rate))
+    producer.start()
+
+    out = np.zeros(nbytes // 8)  # sequence numbers start at 1
+    latencies, seqs, t_first, t_last = [], [], None, None
+    while consumer.recv(out, time.perf_counter() + timeout + 0.5) and out[1] != _STOP:
+        t_last = time.perf_counter()
+        t_first = t_first or t_last
+        latencies.append(t_last - out[0])
+        seqs.append(out[1])
+    producer.join()
+    consumer.close()
+
+    latencies = np.array(latencies) * 1e6
+    received = len(np.unique(seqs))
+    res = {"sent": n_messages, "received": received, "skipped": n_messages - received}
+    for key, q in (("p50_us", 50), ("p99_us", 99), ("p999_us", 99.9)):
+        res[key] = float(np.percentile(latencies, q)) if received else None
+    if interval == 0 and getattr(transport, "latest_value", False):
+        # back to back, payloads overwrite each other before the consumer looks: time the writes
+        res["throughput_of"] = "writes"
+        res["msgs_per_s"] = write_rate.value
+    else:
+        res["throughput_of"] = "receives"
+        res["msgs_per_s"] = received / (t_last - t_first) if received > 1 else None  # needs two payloads to time
+    res["MB_per_s"] = res["msgs_per_s"] * nbytes / 1e6 if res["msgs_per_s"] is not None else None
+    return res
+
+
+def run(transports=None, sizes=PAYLOAD_SIZES, n_messages=2000, interval=1e-3, verbose=True):
+    """ Latency and throughput of every transport/size. Returns a report dict keyed as transport/size/mode """
+    report = {
+        "meta": {
+            "numpy": np.__version__,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": multiprocessing.cpu_count(),
+            "n_messages": n_messages,
+            "interval": interval,
+        },
+        "results": {},
+    }
+    for name in transports or tuple(TRANSPORTS.keys()):
+        for nbytes in sizes:
+            for mode, mode_interval in (("latency", interval), ("throughput", 0.0)):
+                res = measure(name, nbytes, n_messages=n_messages, interval=mode_interval)
+                key = f"{name}/{nbytes}/{mode}"
+                report["results"][key] = res
+                if verbose and "sent" not in res:
+                    print(f"{key:<32} skipped: {res['skipped']}")
+                elif verbose:
+                    num = {k: np.nan if v is None else v for k, v in res.items()}
+                    print(f"{key:<32} p50 {num['p50_us']:9.1f} us  p99 {num['p99_us']:9.1f} us  p999 {num['p999_us']:9.1f} us"
+                          f"  {num['msgs_per_s']:10.0f} msg/s {num['MB_per_s']:9.1f} MB/s ({res['throughput_of']})"
+                          f"  {res['received']}/{res['sent']} received")
+    return report
+
+
+@click.command(help=DESC)
+@click.option('-t', '--transports', multiple=True, type=click.Choice(list(TRANSPORTS.keys())), help='Transports to run (default: all)')
+@click.option('-s', '--sizes', multiple=True, type=int, default=PAYLOAD_SIZES, help='Payload sizes (bytes, multiple of 8, >= 16)')
+@click.option('-n', '--n_messages', type=int, default=2000, help='Payloads per measurement')
+@click.option('-i', '--interval', type=float, default=1e-3, help='Seconds between payloads in latency mode')
+@click.option('-o', '--save', type=click.Path(), default=None, help='Save report as JSON')
+def main(transports, sizes, n_messages, interval, save):
+    assert all(size >= 16 and size % 8 == 0 for size in sizes), "Invalid payload sizes {}".format(sizes)
+    report = run(transports=transports, sizes=sizes, n_messages=n_messages, interval=interval)
+    if save:
+        with open(save, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report saved to {save}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+import mmap
+import os
+
+import numpy as np
+
+from vtils.ipc.shared_memory import _SEQ_OFFSET, _fifo_notifier, _pack_header, _registrations, _unpack_header, shared_memory_array
+
+HELP = """
+------------------------------------------------------------------------
+File backed variants of shared_memory_array. Same zero copy .val API,
+constructor and attach semantics, but the memory is a memory mapped file:
+it persists across crashes and reboots, and can be opened offline without
+being read into RAM. Writes go to the page cache (flush() for durability).
+    - memmap_array(path, init_array=None, consistent=False)
+    - memmap_array.attach(path, readonly=False)
+Append only, growable time series of records (logging, replay):
+    - memmap_timeseries(path, init_array=None)  # init_array: one record
+    - writer: append(record), append_many(records)
+    - readers: .val -> zero copy view of the records, refresh() / wait_for_update(timeout)
+Files use the shared memory layout (self describing header + data).
+------------------------------------------------------------------------
+"""
+
+_FLAG_APPEND = 2  # memmap_timeseries file: header shape is the record shape, seq counts records
+_GROW_NBYTES = 1 << 20  # minimum growth of a time series file
+
+
+class _file_memory:
+    """ Memory mapped file exposing the SharedMemory interface used by shared_memory_array """
+    def __init__(self, path: str, create: bool = False, size: int = 0, readonly: bool = False):
+        flags = os.O_RDONLY if readonly else os.O_RDWR
+        if create:
+            flags |= os.O_CREAT | os.O_EXCL
+        fd = os.open(path, flags, 0o666)
+        try:
+            if create or size > os.fstat(fd).st_size:
+                os.ftruncate(fd, size)
+            self.size = os.fstat(fd).st_size
+            self._mmap = mmap.mmap(fd, self.size, access=mmap.ACCESS_READ if readonly else mmap.ACCESS_WRITE)
+        finally:
+            os.close(fd)
+        self.buf = memoryview(self._mmap)
+        self.name = path
+        self.readonly = readonly
+
+    def flush(self):
+        self._mmap.flush()
+
+    def close(self):
+        self.buf.release()
+        self._mmap.close()
+
+    def unlink(self):
+        os.unlink(self.name)
+
+
+class memmap_array(shared_memory_array):
+    def __init__(self, path: str, init_array: np.array = None, consistent: bool = False):
+        self._readonly = False
+        super().__init__(path, init_array=init_array, consistent=consistent)
+
+    @classmethod
+    def attach(cls, path: str, readonly: bool = False):
+        """ Open an existing file. Shape, dtype and mode are read from its header. readonly: for offline tools """
+        self = cls.__new__(cls)
+        self._readonly = readonly
+        self.shm = None
+        self.val = None
+        self._seq = None
+        self._notifier = None
+        self._tracked = False
+        self.access_shared_memory(memory_name=path)
+        return self
+
+    def _create_memory(self, name, size):
+        return _file_memory(name, create=True, size=size)
+
+    def _open_memory(self, name):
+        return _file_memory(name, readonly=self._readonly)
+
+    def _map_shared_memory(self, shm):
+        if _unpack_header(shm.buf)["flags"] & _FLAG_APPEND:
+            raise ValueError(f"Vtils:> ({shm.name}) is a time series, open it with memmap_timeseries")
+        super()._map_shared_memory(shm)
+
+    def untrack(self):
+        pass  # files aren't tracked
+
+    def flush(self):
+        """ Write dirty pages to disk (only needed to survive an OS crash) """
+        self.shm.flush()
+
+    def delete_memory(self):
+        if self.shm is not None:
+            self.shm.unlink()
+            _fifo_notifier.remove_dir(self.name)
+            print(f"Vtils:> Memory mapped file ({self.name}) deleted")
+            self.shm = None
+
+
+class memmap_timeseries(memmap_array):
+    """
+    Append only record log. The header sequence counter holds the number of
+    records, committed after the records are written, so readers (and a
+    crashed writer's file) only ever expose complete records.
+    """
+    def __init__(self, path: str, init_array: np.array = None):
+        super().__init__(path, init_array=init_array)
+
+    def register_shared_memory(self, memory_name, memory_value):
+        memory_value = np.asarray(memory_value)
+        header = _pack_header(memory_value.shape, memory_value.dtype, _FLAG_APPEND)
+        shm = self._create_memory(memory_name, size=len(header) + max(_GROW_NBYTES, memory_value.nbytes))
+        shm.buf[:len(header)] = header
+        self._tracked = True
+        self._map_shared_memory(shm)
+
+    def access_shared_memory(self, memory_name, shape=None, dtype=None):
+        super().access_shared_memory(memory_name)
+        if (shape is not None and self.record_shape != tuple(shape)) or (dtype is not None and self.val.dtype != np.dtype(dtype)):
+            found = f"{self.record_shape}, {self.val.dtype}"
+            self.val = self._seq = self._records = None
+            self.close_link()
+            raise ValueError(
+                f"Vtils:> Time series ({memory_name}) holds records ({found}), requested ({shape}, {dtype})"
+            )
+
+    def _map_shared_memory(self, shm):
+        header = _unpack_header(shm.buf)
+        if not header["flags"] & _FLAG_APPEND:
+            raise ValueError(f"Vtils:> ({shm.name}) isn't a time series, open it with memmap_array")
+        self.consistent = False
+        self._seq = np.ndarray((1,), dtype=np.uint64, buffer=shm.buf, offset=_SEQ_OFFSET)
+        self._registrations = _registrations(shm, header)
+        if self._notifier is not None:
+            self._notifier.registrations = self._registrations  # remapped
+        self.record_shape = header["shape"]
+        self._record_nbytes = max(header["dtype"].itemsize * int(np.prod(self.record_shape)), 1)
+        capacity = (shm.size - header["header_nbytes"]) // self._record_nbytes
+        self._records = np.ndarray((capacity,) + self.record_shape, dtype=header["dtype"], buffer=shm.buf, offset=header["header_nbytes"])
+        self.shm = shm
+        self._seen_seq = self.seq
+        self.val = self._records[:len(self)]
+
+    def __len__(self):
+        return self.seq
+
+    @property
+    def capacity(self):
+        """ Number of records the file can hold before growing """
+        return self._records.shape[0]
+
+    def _remap(self, capacity):
+        """ Map the file again, grown to hold at least capacity records (writer) or as written (readers) """
+        header = _unpack_header(self.shm.buf)
+        size = header["header_nbytes"] + capacity * self._record_nbytes
+        # Views of the previous mapping stay valid, it's unmapped once they are all gone
+        self._map_shared_memory(_file_memory(self.name, size=0 if self.shm.readonly else size, readonly=self.shm.readonly))
+
+    # Writer ==========================================================
+
+    def append_many(self, records):
+        """ Append a batch of records (n,) + record_shape """
+        records = np.asarray(records)
+        n, count = records.shape[0], len(self)
+        if count + n > self.capacity:
+            self._remap(max(2 * self.capacity, count + n, _GROW_NBYTES // self._record_nbytes))
+        self._records[count:count + n] = records
+        self._seq[0] += 2 * n  # commit
+        self.val = self._records[:count + n]
+        self._wake_readers()
+
+    def append(self, record):
+        self.append_many(np.asarray(record)[None])
+
+    def write(self, records):
+        """ Append only: same as append_many() """
+        self.append_many(records)
+
+    def notify(self):
+        """ Wake up waiting readers (appends already do) """
+        self._wake_readers()
+
+    # Readers =========================================================
+
+    def refresh(self):
+        """ Update .val with the records appended since the last call. Returns the number of records """
+        count = len(self)
+        if count > self.capacity:
+            self._remap(count)
+        self.val = self._records[:count]
+        return count
+
+    def wait_for_update(self, timeout: float = None):
+        updated = super().wait_for_update(timeout)
+        self.refresh()
+        return updated
+
+    def close_link(self):
+        self._records = None
+        super().close_link()
+
+
+if __name__ == "__main__":
+    import tempfile
+    import time
+    print(HELP)
+
+    # Same API as shared_memory_array, but the values persist in a file
+    path = os.path.join(tempfile.gettempdir(), "vtils_memmap_demo.vtm")
+    state = memmap_array(path, init_array=np.array([1, 1, 2, 3, 5, 8.0]), consistent=True)
+    state.write(state.val * 2)
+    state.close_link()
+    offline = memmap_array.attach(path, readonly=True)
+    print(f"\tPersisted state: {offline.val}, {offline.seq} writes")
+    offline.delete_memory()
+
+    # High rate logging: 1 kHz robot state, appended in batches, replayed offline without copies
+    path = os.path.join(tempfile.gettempdir(), "vtils_timeseries_demo.vtm")
+    record = np.zeros((), dtype=[("time", np.float64), ("qpos", np.float64, (7,)), ("qvel", np.float64, (7,))])
+    log = memmap_timeseries(path, init_array=record)
+    replay = memmap_timeseries.attach(path, readonly=True)
+    batch = np.zeros(100, dtype=record.dtype)
+    n_records = 1_000_000
+    t_start = time.perf_counter()
+    for i in range(0, n_records, batch.shape[0]):
+        batch["time"] = np.arange(i, i + batch.shape[0]) * 1e-3
+        log.append_many(batch)
+    t_total = time.perf_counter() - t_start
+    print(f"\tAppended {len(log)} records in {t_total:.2f}s: {n_records / t_total / 1e6:.2f} M records/s "
+          f"({n_records * record.nbytes / t_total / 1e9:.2f} GB/s), file {os.path.getsize(path) / 1e6:.0f} MB")
+    replay.refresh()
+    print(f"\tReplay: {len(replay)} records, last time {replay.val['time'][-1]:.3f}, "
+          f"in order: {bool(np.all(np.diff(replay.val['time']) > 0))}")
+    replay.close_link()
+    log.close_link()
+    log.delete_memory()
@@ -0,0 +1,210 @@
+DESC = """
+------------------------------------------------------------------------
+Registry and lifecycle manager for vtils shared memories.
+Memories are grouped by namespace (memory name: <namespace>.<name>), and
+every attachment, from any process, is recorded in the registry; a memory
+is unlinked when its last attachment is released. Attachments of crashed
+processes are detected (dead pid), so leftover memories can be listed and
+garbage collected.
+Usage:
+    with shared_memory_registry("robot") as registry:
+        state = registry.create("state", init_array)  # or registry.attach("state")
+        frames = registry.preallocate("frame", init_array, count=4)
+        frame = registry.acquire("frame")             # no shm_open on the hot path
+        registry.release(frame)
+CLI: list (and garbage collect) memories of a namespace
+    python -m vtils.ipc.registry --namespace robot --gc
+------------------------------------------------------------------------
+"""
+
+import fcntl
+import glob
+import os
+import tempfile
+
+import click
+import numpy as np
+
+from vtils.ipc.shared_memory import shared_memory_array
+
+_REGISTRY_DIR = os.path.join(tempfile.gettempdir(), "vtils_registry")
+_SHM_DIR = "/dev/shm"  # where posix shared memories are listed (linux)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # alive, owned by another user
+    return True
+
+
+class shared_memory_registry:
+    def __init__(self, namespace: str = "vtils"):
+        assert namespace and "." not in namespace and "/" not in namespace, "Invalid namespace {}".format(namespace)
+        self.namespace = namespace
+        self.dir = os.path.join(_REGISTRY_DIR, namespace)
+        os.makedirs(self.dir, exist_ok=True)
+        self._lock_file = open(os.path.join(self.dir, ".lock"), "a")
+        self._held = {}  # id(array): (array, attachment entry path)
+        self._pools = {}  # pool name: free arrays
+        self._pooled = {}  # id(array): pool name
+        self._free = set()  # id(array) of the pooled arrays in their pool
+
+    def memory_name(self, name):
+        """ Full memory name of name (already full names are kept) """
+        return name if name.startswith(self.namespace + ".") else f"{self.namespace}.{name}"
+
+    # Locking and bookkeeping =========================================
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _locked(self):
+        return _file_lock(self._lock_file)
+
+    def _entries(self, memory_name):
+        """ Attachment entries (<pid>-<id>) of memory_name, entries of dead processes are pruned """
+        entries = []
+        for path in glob.glob(os.path.join(self.dir, memory_name, "*")):
+            if _pid_alive(int(os.path.basename(path).split("-")[0])):
+                entries.append(path)
+            else:
+                os.unlink(path)
+        return entries
+
+    def _hold(self, arr):
+        entry = os.path.join(self.dir, arr.name, f"{os.getpid()}-{id(arr)}")
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        open(entry, "w").close()
+        self._held[id(arr)] = (arr, entry)
+        return arr
+
+    def _unlink(self, memory_name):
+        try:
+            shared_memory_array.attach(memory_name).delete_memory()
+        except (FileNotFoundError, ValueError):  # gone, or not a vtils memory
+            pass
+        try:
+            os.rmdir(os.path.join(self.dir, memory_name))
+        except OSError:
+            pass
+
+    # Attachments =====================================================
+
+    def create(self, name: str, init_array: np.array, consistent: bool = False):
+        """ Create memory name (attach if it exists). See shared_memory_array """
+        with self._locked():
+            arr = shared_memory_array(self.memory_name(name), init_array=init_array, consistent=consistent)
+            arr.untrack()  # the registry, not the creator's exit, decides when it's unlinked
+            return self._hold(arr)
+
+    def attach(self, name: str):
+        """ Attach to existing memory name """
+        with self._locked():
+            return self._hold(shared_memory_array.attach(self.memory_name(name)))
+
+    def release(self, arr):
+        """ Release an attachment (pooled arrays go back to their pool). The last release unlinks the memory """
+        if id(arr) in self._pooled:
+            if id(arr) in self._free:
+                raise ValueError(f"Vtils:> Shared memory ({arr.name}) already released to its pool")
+            self._pools[self._pooled[id(arr)]].append(arr)
+            self._free.add(id(arr))
+            return
+        with self._locked():
+            _, entry = self._held.pop(id(arr))
+            os.unlink(entry)
+            memory_name = arr.name
+            arr.close_link()
+            if not self._entries(memory_name):
+                self._unlink(memory_name)
+
+    def refcount(self, name: str):
+        """ Number of live attachments of memory name, across processes """
+        with self._locked():
+            return len(self._entries(self.memory_name(name)))
+
+    # Pool ============================================================
+
+    def preallocate(self, name: str, init_array: np.array, count: int):
+        """ Create count memories <name>.<i> shaped like init_array, to be handed out by acquire(name) """
+        arrs = [self.create(f"{name}.{i}", init_array) for i in range(count)]
+        self._pools.setdefault(name, []).extend(arrs)
+        for arr in arrs:
+            self._pooled[id(arr)] = name
+            self._free.add(id(arr))
+        return arrs
+
+    def acquire(self, name: str):
+        """
+        Free memory from pool name, already mapped (no shm_open). Other processes
+        attach with attach(arr.name). Raises IndexError if the pool is exhausted.
+        """
+        pool = self._pools[name]
+        if not pool:
+            raise IndexError(f"Vtils:> Shared memory pool ({name}) exhausted ({len(self._pooled)} preallocated)")
+        arr = pool.pop()
+        self._free.discard(id(arr))
+        return arr
+
+    # Maintenance =====================================================
+
+    def list(self):
+        """ {memory name: live attachments} of the namespace, orphans (no attachments) included """
+        with self._locked():
+            names = {os.path.basename(path) for path in glob.glob(os.path.join(self.dir, self.namespace + ".*"))}
+            names |= {os.path.basename(path) for path in glob.glob(os.path.join(_SHM_DIR, self.namespace + ".*"))}
+            return {name: len(self._entries(name)) for name in sorted(names)}
+
+    def gc(self):
+        """ Unlink orphans: memories whose attachments all belong to dead processes. Returns their names """
+        orphans = [name for name, refcount in self.list().items() if refcount == 0]
+        with self._locked():
+            for name in orphans:
+                if not self._entries(name):  # not attached since listed
+                    self._unlink(name)
+        return orphans
+
+    def close(self):
+        """ Release every attachment made through this registry, pools included """
+        self._pooled.clear()
+        self._pools.clear()
+        self._free.clear()
+        for arr, _ in list(self._held.values()):
+            self.release(arr)
+        self._lock_file.close()
+
+
+class _file_lock:
+    """ Exclusive inter process lock, held by the registry while it (un)links and counts """
+    def __init__(self, file):
+        self.file = file
+
+    def __enter__(self):
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+
+
+@click.command(help=DESC)
+@click.option('-n', '--namespace', type=str, default="vtils", help='Namespace to inspect')
+@click.option('-g', '--gc', 'collect', is_flag=True, help='Unlink orphaned memories')
+def main(namespace, collect):
+    registry = shared_memory_registry(namespace)
+    for name, refcount in registry.list().items():
+        print(f"{name:<40} {refcount} attachments{' (orphan)' if refcount == 0 else ''}")
+    if collect:
+        for name in registry.gc():
+            print(f"Vtils:> Shared memory ({name}) garbage collected")
+    registry.close()
+
+
+if __name__ == '__main__':
+    main()
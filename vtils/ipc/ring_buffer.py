@@ -0,0 +1,160 @@
+import numpy as np
+
+from vtils.ipc.shared_memory import shared_memory_array
+
+HELP = """
+------------------------------------------------------------------------
+Single producer / multi consumer ring buffer of fixed size numpy records
+over shared memory. Producers never block; consumers that fall more than
+capacity records behind lose the oldest records (counted in overruns).
+Input:
+    - name:         name of the shared memory
+    - dtype:        record dtype (structured dtypes welcome)
+                    - used to create shared memory if one doesn't exists
+                    - omit dtype/capacity to attach to an existing ring
+    - capacity:     number of records held
+    - record_shape: (optional) shape of each record
+Usage:
+    - producer: ring.push(record), ring.push_many(records)
+    - consumer: ring.pop_many(max_n) -> zero copy view of new records
+                ring.intact() -> False if the producer overwrote the last popped view
+------------------------------------------------------------------------
+"""
+
+# Control block (first field of the segment): 8 uint64 = 64 bytes, keeps records cache line aligned
+_HEAD = 0       # records committed
+_RESERVED = 1   # records committed + being written
+
+
+class shared_ring_buffer:
+    def __init__(self, name: str, dtype=None, capacity: int = None, record_shape: tuple = ()):
+        if dtype is None and capacity is None:
+            self.buffer = shared_memory_array.attach(name)
+        else:
+            layout = np.dtype([
+                ("ctrl", np.uint64, (8,)),
+                ("records", np.dtype(dtype), (capacity,) + tuple(record_shape)),
+            ])
+            # a zeroed record of the whole layout, allocated locally once to initialize the memory
+            self.buffer = shared_memory_array(name, init_array=np.zeros((), dtype=layout))
+        self.ctrl = self.buffer.val["ctrl"]
+        self.records = self.buffer.val["records"]
+        self.capacity = self.records.shape[0]
+
+        # Consumer state (local to this instance): only records pushed from now on are popped
+        self.tail = self.head
+        self.overruns = 0
+        self._batch_start = self.tail
+
+    @property
+    def head(self):
+        """ Total number of records pushed """
+        return int(self.ctrl[_HEAD])
+
+    # Producer ========================================================
+
+    def push(self, record):
+        head = int(self.ctrl[_HEAD])
+        self.ctrl[_RESERVED] = head + 1
+        self.records[head % self.capacity] = record
+        self.ctrl[_HEAD] = head + 1
+
+    def push_many(self, records):
+        """ Push a batch of records (n, ...). Only the last capacity records are kept if n > capacity """
+        records = np.asarray(records)
+        n = records.shape[0]
+        if n > self.capacity:
+            records = records[n - self.capacity:]
+        head = int(self.ctrl[_HEAD])
+        self.ctrl[_RESERVED] = head + n
+
+        # copy in (at most) two contiguous chunks
+        start = (head + n - records.shape[0]) % self.capacity
+        n_first = min(records.shape[0], self.capacity - start)
+        self.records[start:start + n_first] = records[:n_first]
+        self.records[:records.shape[0] - n_first] = records[n_first:]
+        self.ctrl[_HEAD] = head + n
+
+    # Consumer ========================================================
+
+    def _skip_overrun(self):
+        # records older than reserved - capacity are (being) overwritten
+        oldest = int(self.ctrl[_RESERVED]) - self.capacity
+        if self.tail < oldest:
+            self.overruns += oldest - self.tail
+            self.tail = oldest
+
+    def available(self):
+        """ Number of records ready to be popped """
+        self._skip_overrun()
+        return self.head - self.tail
+
+    def pop_many(self, max_n: int = None):
+        """
+        Zero copy view of up to max_n new records (empty if none).
+        The view is contiguous, so it stops at the wrap around; call again for the rest.
+        Views are valid until the producer laps them, check with intact().
+        """
+        head = self.head
+        self._skip_overrun()
+        start = self.tail % self.capacity
+        n = min(head - self.tail, self.capacity - start)
+        if max_n is not None:
+            n = min(n, max_n)
+        self._batch_start = self.tail
+        self.tail += n
+        return self.records[start:start + n]
+
+    def pop(self):
+        """ Zero copy view of the next record, None if none available """
+        batch = self.pop_many(1)
+        return batch[0] if batch.shape[0] else None
+
+    def intact(self):
+        """ True if the last popped view hasn't been overwritten by the producer """
+        return int(self.ctrl[_RESERVED]) - self.capacity <= self._batch_start
+
+    def close_link(self):
+        self.ctrl = self.records = None
+        self.buffer.val = None
+        self.buffer.close_link()
+
+    def delete_memory(self):
+        self.buffer.delete_memory()
+
+
+def _benchmark_producer(name, n_records, batch):
+    ring = shared_ring_buffer(name)
+    records = np.zeros(batch, dtype=ring.records.dtype)
+    for i in range(0, n_records, batch):
+        records["seq"] = np.arange(i, i + batch)
+        ring.push_many(records)
+    ring.close_link()
+
+
+if __name__ == "__main__":
+    import multiprocessing
+    import time
+    print(HELP)
+
+    # Throughput: one producer process, one consumer (this process)
+    dtype = np.dtype([("seq", np.int64), ("time", np.float64), ("data", np.float32, (6,))])
+    n_records, batch = 10_000_000, 1000
+    ring = shared_ring_buffer("vtils_ring_demo", dtype=dtype, capacity=1 << 20)
+
+    producer = multiprocessing.Process(target=_benchmark_producer, args=("vtils_ring_demo", n_records, batch))
+    t_start = time.time()
+    producer.start()
+    n_received, checksum = 0, 0
+    while n_received + ring.overruns < n_records:
+        records = ring.pop_many()
+        if records.shape[0]:
+            checksum += int(records["seq"][-1] - records["seq"][0] + 1)
+            n_received += records.shape[0]
+    t_total = time.time() - t_start
+    producer.join()
+
+    print(f"Records: {n_received} received, {ring.overruns} overrun, sequence check: {checksum == n_received}")
+    print(f"Throughput: {n_records / t_total / 1e6:.2f} M records/s ({n_records * dtype.itemsize / t_total / 1e9:.2f} GB/s)")
+    ring.close_link()
+    ring.delete_memory()
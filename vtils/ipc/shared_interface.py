@@ -11,7 +11,8 @@ Step
   - python shared_interface.py
 2. Access the shared memory interface values from other programs using
   - from vtils.ipc.shared_memory import shared_memory_array
-  - user_ui = shared_memory_array(name="shared_interface", dtype=np.float64, shape=(10,))
+  - user_ui = shared_memory_array.attach(name="shared_interface")
+  - user_ui.wait_for_update(timeout) blocks until the interface changes
 """
 
 n_sl = 5
@@ -27,11 +28,13 @@ ui = []
 def sl_update(val):
     for i_ui in range(n_sl):
         ui_buffer.val[i_ui] = ui[i_ui].val
+    ui_buffer.notify()
 
 
 # Update button buffers with UI values
 def bt_update(event, button_index):
     ui_buffer.val[button_index] = 1
+    ui_buffer.notify()
     print(event, button_index)
 
 
@@ -1,7 +1,23 @@
-from multiprocessing import shared_memory
+import ast
+import glob
+import os
+import select
+import struct
+import sys
+import tempfile
+import threading
+import time
+import types
+from multiprocessing import resource_tracker, shared_memory
 
 import numpy as np
 
+# FIFO notifications are posix only, as is the lock serializing their registration
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 HELP = """
 ------------------------------------------------------------------------
 Utility to quickly create on a shared memory array that can be accessed
@@ -11,16 +27,223 @@ Input:
     - init_array :  initial values of the array
                     - used to create shared memory if one doesn't exists
                     - used to determine memory shape and dtype
+                    - optional when attaching to an existing memory
+                    - structured dtypes are supported (named fields)
+    - consistent :  (optional) guard the array with a sequence counter (seqlock)
+                    - writer uses write(arr), readers use read(out=...)
+                    - readers never observe a half written array
 Output: shared_memory_array
+
+Segments are self describing (shape, dtype, fields and mode are stored in a
+header), so other programs can attach without knowing them:
+    - shared_memory_array.attach(name)
+
+Readers can block until the next update instead of polling:
+    - writer: write(arr), or edit .val directly and call notify()
+    - reader: wait_for_update(timeout) -> True if updated
+
+Large frames (camera images): shared_triple_buffer(name, init_array)
+    - writer fills a back buffer, then publishes it: write(frame), or back() + publish()
+    - readers get zero copy views of the latest complete frame: latest(), intact()
 ------------------------------------------------------------------------
 """
 
+# Segment layout: [header | metadata | padding] [data]
+# Header: magic, version, flags, header_nbytes (= data offset), meta_nbytes, seq counter, reader registrations
+# Metadata: python literal of {'descr', 'shape', 'fields'}, same encoding as .npy headers
+# Version 1 segments (no reader registrations counter) are still read
+_MAGIC = b"VTILSSHM"
+_VERSION = 2
+_HEADER = struct.Struct("<8sIIIIQQ")
+_HEADER_V1 = struct.Struct("<8sIIIIQ")
+_SEQ_OFFSET = 24
+_REGISTRATIONS_OFFSET = 32
+_ALIGN = 64  # data starts cache line aligned
+_FLAG_CONSISTENT = 1
+
+
+def _pack_header(shape, dtype, flags):
+    """ Header bytes (padded to _ALIGN) describing an array of shape/dtype """
+    meta = repr({
+        "descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+        "shape": tuple(shape),
+        "fields": np.dtype(dtype).names,
+    }).encode("utf-8")
+    header_nbytes = -(-(_HEADER.size + len(meta)) // _ALIGN) * _ALIGN
+    header = _HEADER.pack(_MAGIC, _VERSION, flags, header_nbytes, len(meta), 0, 0) + meta
+    return header.ljust(header_nbytes, b"\0")
+
+
+def _unpack_header(buf):
+    """ Decode the header of a vtils shared memory segment """
+    magic, version, flags, header_nbytes, meta_nbytes, _ = _HEADER_V1.unpack_from(buf, 0)
+    if magic != _MAGIC:
+        raise ValueError("Vtils:> Not a vtils shared memory segment (bad magic)")
+    if version not in (1, _VERSION):
+        raise ValueError(f"Vtils:> Unsupported shared memory version {version}")
+    meta_offset = _HEADER.size if version == _VERSION else _HEADER_V1.size
+    meta = ast.literal_eval(bytes(buf[meta_offset:meta_offset + meta_nbytes]).decode("utf-8"))
+    return {
+        "version": version,
+        "flags": flags,
+        "header_nbytes": header_nbytes,
+        "dtype": np.lib.format.descr_to_dtype(meta["descr"]),
+        "shape": tuple(meta["shape"]),
+    }
+
+
+_TRACKER_LOCK = threading.Lock()
+_NO_TRACKER = types.SimpleNamespace(register=lambda name, rtype: None)
+
+
+def _open_untracked(name):
+    """
+    Open an existing memory without registering it with python's resource_tracker,
+    which would unlink it when this process exits (even though other processes use it).
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    with _TRACKER_LOCK:
+        shared_memory.resource_tracker = _NO_TRACKER
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            shared_memory.resource_tracker = resource_tracker
+
+
+def _registrations(shm, header):
+    """ View of the reader registrations counter of a segment (None for version 1 segments) """
+    if header["version"] == 1:
+        return None
+    return np.ndarray((1,), dtype=np.uint64, buffer=shm.buf, offset=_REGISTRATIONS_OFFSET)
+
+
+def _untrack(shm):
+    """ Unregister a memory created by this process from python's resource_tracker """
+    if os.name == "posix":
+        resource_tracker.unregister(shm._name, "shared_memory")
+
+
+class _fifo_notifier:
+    """
+    Wakes up readers of a shared memory across processes.
+    Each waiting reader owns a FIFO in a per memory directory; writers poke every FIFO.
+    Readers count their registration in the segment header once their FIFO is in place,
+    writers rescan the directory when that count (or the directory's mtime) changes.
+    Readers that left are dropped on their first failed poke. Without the count (version 1
+    segments, read only files) readers arriving within the mtime granularity can be missed.
+    """
+    supported = hasattr(os, "mkfifo")
+
+    def __init__(self, name: str, registrations: np.ndarray = None):
+        """ registrations: reader registrations counter of the segment (see _registrations) """
+        self.dir = os.path.join(tempfile.gettempdir(), "vtils_shm_" + name.lstrip("/").replace("/", "_"))
+        self.registrations = registrations
+        self.path = None
+        self.fd = self._dummy_fd = None  # reader side
+        self.writer_fds = {}  # writer side, FIFO path: fd
+        self._seen = None  # directory mtime and registrations count of the last rescan
+
+    def fileno(self):
+        """ Reader FIFO, registered on first use. Readable when woken up """
+        if self.fd is None:
+            os.makedirs(self.dir, exist_ok=True)
+            tmp_path = os.path.join(self.dir, f".{os.getpid()}-{id(self)}")
+            os.mkfifo(tmp_path)
+            self.fd = os.open(tmp_path, os.O_RDONLY | os.O_NONBLOCK)
+            # Our own writer end keeps the FIFO from reporting hang ups between writers
+            self._dummy_fd = os.open(tmp_path, os.O_WRONLY | os.O_NONBLOCK)
+            # Publish only once open, so that writers never mistake it for a stale FIFO
+            self.path = tmp_path.replace(os.sep + ".", os.sep, 1) + ".fifo"
+            os.rename(tmp_path, self.path)
+            if self.registrations is not None and self.registrations.flags.writeable:
+                self._register()
+        return self.fd
+
+    def _register(self):
+        """ Count our registration, serialized across readers so that no increment is lost """
+        with open(os.path.join(self.dir, "registrations.lock"), "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            self.registrations[0] += 1
+
+    def wait(self, timeout):
+        """ Block until woken up or timeout (None: forever) """
+        select.select([self.fileno()], [], [], timeout)
+        try:
+            os.read(self.fd, 4096)  # drain pending wake ups
+        except BlockingIOError:
+            pass
+
+    def wake(self):
+        try:
+            seen = (os.stat(self.dir).st_mtime_ns, None if self.registrations is None else int(self.registrations[0]))
+        except FileNotFoundError:
+            return  # no reader ever waited
+        if seen != self._seen:
+            self._seen = seen
+            self._rescan()
+        for path, fd in list(self.writer_fds.items()):
+            try:
+                os.write(fd, b"\0")
+            except BlockingIOError:
+                pass  # reader has pending wake ups already
+            except BrokenPipeError:
+                self._drop(path, unlink=True)  # reader died
+
+    def _rescan(self):
+        paths = set(glob.glob(os.path.join(self.dir, "*.fifo")))
+        for path in set(self.writer_fds) - paths:
+            self._drop(path, unlink=False)
+        for path in paths - set(self.writer_fds):
+            try:
+                self.writer_fds[path] = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError:  # ENXIO: no reader, left behind by a crashed process
+                self._unlink(path)
+
+    def _drop(self, path, unlink):
+        os.close(self.writer_fds.pop(path))
+        if unlink:
+            self._unlink(path)
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    @classmethod
+    def remove_dir(cls, name: str):
+        """ Remove FIFOs left by readers of memory name """
+        directory = cls(name).dir
+        for path in glob.glob(os.path.join(directory, "*")):
+            cls._unlink(path)
+        try:
+            os.rmdir(directory)
+        except OSError:
+            pass
+
+    def close(self):
+        for path in list(self.writer_fds):
+            self._drop(path, unlink=False)
+        if self.fd is not None:
+            self._unlink(self.path)
+            os.close(self.fd)
+            os.close(self._dummy_fd)
+            self.fd = self._dummy_fd = None
+
 
 class shared_memory_array:
-    def __init__(self, name: str, init_array: np.array):  # initial array values to use
+    def __init__(self, name: str, init_array: np.array = None, consistent: bool = False):  # initial array values to use
         self.shm = None
         self.val = None
+        self.consistent = consistent
+        self._seq = None
+        self._notifier = None
+        self._tracked = False
 
+        shape = dtype = None
         if init_array is not None:
             shape = init_array.shape
             dtype = init_array.dtype
@@ -39,24 +262,149 @@ class shared_memory_array:
                 )
                 self.register_shared_memory(memory_name=name, memory_value=init_array)
 
+    @classmethod
+    def attach(cls, name: str):
+        """ Attach to an existing shared memory. Shape, dtype and mode are read from its header """
+        self = cls.__new__(cls)
+        self.shm = None
+        self.val = None
+        self._seq = None
+        self._notifier = None
+        self._tracked = False
+        self.access_shared_memory(memory_name=name)
+        return self
+
     def register_shared_memory(self, memory_name, memory_value):
-        shm = shared_memory.SharedMemory(
-            create=True, size=memory_value.nbytes, name=memory_name
-        )
-        val_shared = np.ndarray(
-            memory_value.shape, dtype=memory_value.dtype, buffer=shm.buf
-        )
-        val_shared[:] = memory_value[:]  # Copy the original data into shared memory
+        memory_value = np.asarray(memory_value)
+        header = _pack_header(memory_value.shape, memory_value.dtype, _FLAG_CONSISTENT if self.consistent else 0)
+        shm = self._create_memory(memory_name, size=len(header) + memory_value.nbytes)
+        shm.buf[:len(header)] = header
+        self._tracked = True  # creator's resource_tracker unlinks the memory if it exits without delete_memory()
+        self._map_shared_memory(shm)
+        self.val[...] = memory_value  # Copy the original data into shared memory
+
+    def access_shared_memory(self, memory_name, shape=None, dtype=None):
+        existing_shm = self._open_memory(memory_name)
+        try:
+            self._map_shared_memory(existing_shm)
+        except ValueError:
+            existing_shm.close()
+            raise
+        if (shape is not None and self.val.shape != tuple(shape)) or (dtype is not None and self.val.dtype != np.dtype(dtype)):
+            found = f"{self.val.shape}, {self.val.dtype}"
+            self.val = self._seq = None
+            self.close_link()
+            raise ValueError(
+                f"Vtils:> Shared memory ({memory_name}) holds ({found}), requested ({shape}, {dtype})"
+            )
+
+    def _create_memory(self, name, size):
+        return shared_memory.SharedMemory(create=True, size=size, name=name)
+
+    def _open_memory(self, name):
+        # Readers don't own the memory: don't let our resource_tracker unlink it when we exit
+        return _open_untracked(name)
+
+    def _map_shared_memory(self, shm):
+        header = _unpack_header(shm.buf)
+        self.consistent = bool(header["flags"] & _FLAG_CONSISTENT)
+        # Even: data is stable, Odd: write in progress
+        self._seq = np.ndarray((1,), dtype=np.uint64, buffer=shm.buf, offset=_SEQ_OFFSET)
+        self._registrations = _registrations(shm, header)
+        self.val = np.ndarray(header["shape"], dtype=header["dtype"], buffer=shm.buf, offset=header["header_nbytes"])
         self.shm = shm
-        self.val = val_shared
+        self._seen_seq = self.seq
+
+    def untrack(self):
+        """ Hand the lifecycle of a created memory to the caller (see registry.py): it outlives this process """
+        if self._tracked:
+            _untrack(self.shm)
+            self._tracked = False
+
+    @property
+    def fields(self):
+        """ Field names of structured dtypes (None otherwise) """
+        return self.val.dtype.names
+
+    def write(self, arr):
+        """
+        Copy arr into the shared memory. In consistent mode, concurrent readers
+        using read() never see a partial update. Assumes a single writer.
+        """
+        if self.consistent:
+            self._seq[0] += 1  # odd: write in progress
+            self.val[...] = arr
+            self._seq[0] += 1  # even: write done
+        else:
+            self.val[...] = arr
+            self._seq[0] += 2
+        self._wake_readers()
+
+    def notify(self):
+        """ Publish an update made directly through .val, and wake up waiting readers """
+        self._seq[0] += 2
+        self._wake_readers()
+
+    def _get_notifier(self):
+        if self._notifier is None and _fifo_notifier.supported:
+            self._notifier = _fifo_notifier(self.name, self._registrations)
+        return self._notifier
+
+    def _wake_readers(self):
+        if self._get_notifier() is not None:
+            self._notifier.wake()
 
-    def access_shared_memory(self, memory_name, shape, dtype):
-        existing_shm = shared_memory.SharedMemory(name=memory_name)
-        val_shared = np.ndarray(shape, dtype=dtype, buffer=existing_shm.buf)
-        self.shm = existing_shm
-        self.val = val_shared
+    def wait_for_update(self, timeout: float = None):
+        """
+        Block until the memory is updated through write()/notify(), or timeout (seconds, None: forever).
+        Returns True if updated since the last call (or since attaching), False on timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        notifier = self._get_notifier()
+        if notifier is not None:
+            notifier.fileno()  # register before checking, so that no update is missed
+        while True:
+            seq = self.seq
+            if seq != self._seen_seq:
+                self._seen_seq = seq
+                return True
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            if notifier is not None:
+                notifier.wait(remaining)
+            else:  # no FIFOs on this platform, poll
+                time.sleep(1e-3 if remaining is None else min(remaining, 1e-3))
+
+    def read(self, out=None):
+        """
+        Copy the shared memory into out (allocated if None) and return it. In consistent
+        mode, the copy is retried until it didn't overlap with a write.
+        """
+        if out is None:
+            out = np.empty_like(self.val)
+        if not self.consistent:
+            out[...] = self.val
+            return out
+
+        while True:
+            seq = int(self._seq[0])
+            if seq & 1:
+                time.sleep(0)  # writer is mid update, yield and retry
+                continue
+            out[...] = self.val
+            if int(self._seq[0]) == seq:
+                return out
+
+    @property
+    def seq(self):
+        """ Number of completed updates (write() or notify() calls) """
+        return int(self._seq[0]) // 2
 
     def close_link(self):
+        if self._notifier is not None:
+            self._notifier.close()
+            self._notifier = None
         if self.shm is not None:
             # Close access to the shared memory from this instance.
             self.shm.close()
@@ -65,7 +413,10 @@ class shared_memory_array:
     def delete_memory(self):
         if self.shm is not None:
             # Request that the underlying shared memory block be destroyed. Call only once
+            if not self._tracked and os.name == "posix":
+                resource_tracker.register(self.shm._name, "shared_memory")  # unlink() unregisters it
             self.shm.unlink()
+            _fifo_notifier.remove_dir(self.name)
             print(f"Vtils:> Shared memory ({self.name}) deleted")
             self.shm = None
 
@@ -78,6 +429,133 @@ class shared_memory_array:
         self.close_link()
 
 
+class shared_triple_buffer:
+    """
+    Latest frame mailbox for large arrays. The writer rotates through n_buffers
+    frames, filling one while readers view the latest published one, so that
+    neither side waits on a copy. A viewed frame is only overwritten once the
+    writer has published n_buffers - 1 newer ones; check with intact().
+    Assumes a single writer.
+    """
+    def __init__(self, name: str, init_array: np.array = None, n_buffers: int = 3):
+        if init_array is None:
+            self.buffer = shared_memory_array.attach(name)
+        else:
+            layout = np.dtype([
+                ("ctrl", np.uint64, (8,)),  # published count, buffer generations (odd: being written)
+                ("frames", init_array.dtype, (n_buffers,) + init_array.shape),
+            ])
+            assert 2 <= n_buffers <= 7, "Invalid n_buffers {}".format(n_buffers)
+            # a zeroed record of the whole layout, allocated locally once to initialize the memory
+            self.buffer = shared_memory_array(name, init_array=np.zeros((), dtype=layout))
+        self.ctrl = self.buffer.val["ctrl"]
+        self.frames = self.buffer.val["frames"]
+        self.n_buffers = self.frames.shape[0]
+        self._generation = self.ctrl[1:1 + self.n_buffers]
+        self._viewed = (0, 0)  # (buffer index, generation) of the last latest() view
+
+    @property
+    def count(self):
+        """ Total number of frames published """
+        return int(self.ctrl[0])
+
+    # Writer ==========================================================
+
+    def back(self):
+        """ Zero copy view of the buffer to fill next. Call publish() once filled """
+        index = self.count % self.n_buffers
+        if not self._generation[index] & 1:
+            self._generation[index] += 1  # odd: being written
+        return self.frames[index]
+
+    def publish(self):
+        """ Make the back buffer the latest frame, and wake up waiting readers. Call back() first """
+        index = self.count % self.n_buffers
+        if not self._generation[index] & 1:
+            raise RuntimeError("Vtils:> publish() without back(): no frame is being written")
+        self._generation[index] += 1  # even: complete
+        self.ctrl[0] = self.count + 1
+        self.buffer.notify()
+
+    def write(self, frame):
+        """ Copy frame into the back buffer and publish it """
+        self.back()[...] = frame
+        self.publish()
+
+    # Readers =========================================================
+
+    def latest(self):
+        """
+        Zero copy view of the latest complete frame (None if nothing published yet).
+        Valid until the writer laps it, check with intact().
+        """
+        while True:
+            count = self.count
+            if count == 0:
+                return None
+            index = (count - 1) % self.n_buffers
+            generation = int(self._generation[index])
+            if not generation & 1:
+                self._viewed = (index, generation)
+                return self.frames[index]
+            # lapped while looking it up, retry on the newer frame
+
+    def intact(self):
+        """ True if the last latest() view hasn't been overwritten by the writer """
+        index, generation = self._viewed
+        return int(self._generation[index]) == generation
+
+    def read(self, out=None):
+        """ Copy the latest complete frame into out (allocated if None) and return it """
+        if out is None:
+            out = np.empty_like(self.frames[0])
+        while True:
+            frame = self.latest()
+            if frame is None:
+                out[...] = 0
+                return out
+            out[...] = frame
+            if self.intact():
+                return out
+
+    def wait_for_update(self, timeout: float = None):
+        """ Block until a new frame is published, or timeout. See shared_memory_array """
+        return self.buffer.wait_for_update(timeout)
+
+    def close_link(self):
+        self.ctrl = self.frames = self._generation = None
+        self.buffer.val = None
+        self.buffer.close_link()
+
+    def delete_memory(self):
+        self.buffer.delete_memory()
+
+
+def _notify_writer(name, n_updates):
+    stamp = shared_memory_array.attach(name)
+    time.sleep(0.2)
+    for _ in range(n_updates):
+        stamp.val[0] = time.perf_counter()
+        stamp.notify()
+        time.sleep(1e-3)
+    stamp.close_link()
+
+
+def _frame_reader(name, results):
+    frames = shared_triple_buffer(name)
+    n_frames, n_torn, latencies = 0, 0, []
+    while frames.wait_for_update(timeout=2.0):
+        frame = frames.latest()
+        if frame[-1, -1, 0] == 255:
+            break
+        latencies.append(time.perf_counter() - frame.reshape(-1)[:8].view(np.float64)[0])
+        frame[1::64, ::64].sum()  # touch the frame
+        n_torn += not frames.intact()
+        n_frames += 1
+    results.put((n_frames, n_torn, np.median(latencies)))
+    frames.close_link()
+
+
 if __name__ == "__main__":
     print(HELP)
     user_data = np.array([1, 1, 2, 3, 5, 8.0])
@@ -102,3 +580,63 @@ if __name__ == "__main__":
 
     # Request removal of shared memory. Only one process needs to call it
     shared_user_data.delete_memory()
+
+    # Tear free updates: writer uses write(), readers use read()
+    writer = shared_memory_array(name="shared_mem_seq", init_array=user_data, consistent=True)
+    reader = shared_memory_array(name="shared_mem_seq", init_array=user_data, consistent=True)
+    reader_buffer = np.empty_like(user_data)
+    for i in range(3):
+        writer.write(user_data * i)
+        print(f"\t[Write{reader.seq}]: Consistent read: {reader.read(out=reader_buffer)}")
+    reader.close_link()
+    writer.close_link()
+    writer.delete_memory()
+
+    # Self describing memory: attach without knowing shape/dtype. Structured dtypes hold named fields
+    robot_state = np.zeros(1, dtype=[("time", np.float64), ("qpos", np.float64, (7,)), ("gripper", np.float32)])
+    shared_state = shared_memory_array(name="shared_mem_state", init_array=robot_state)
+    shared_state.val["qpos"] = np.arange(7)
+    attached_state = shared_memory_array.attach("shared_mem_state")
+    print(f"\tAttached fields {attached_state.fields}, qpos: {attached_state.val['qpos']}")
+    attached_state.close_link()
+    shared_state.close_link()
+    shared_state.delete_memory()
+
+    # Change notification: reader blocks in wait_for_update() until the writer process updates
+    import multiprocessing
+    stamp = shared_memory_array(name="shared_mem_stamp", init_array=np.zeros(1))
+    n_updates = 1000
+    writer = multiprocessing.Process(target=_notify_writer, args=("shared_mem_stamp", n_updates))
+    writer.start()
+    latencies = []
+    while len(latencies) < n_updates and stamp.wait_for_update(timeout=1.0):
+        latencies.append(time.perf_counter() - stamp.val[0])
+    writer.join()
+    print(f"\tWake up latency over {len(latencies)} updates: p50 {np.percentile(latencies, 50)*1e6:.1f} us, "
+          f"p99 {np.percentile(latencies, 99)*1e6:.1f} us")
+    stamp.close_link()
+    stamp.delete_memory()
+
+    # Triple buffering: 4K RGB frames at 60 Hz to several reader processes, zero copy
+    frame = np.zeros((2160, 3840, 3), dtype=np.uint8)
+    frames = shared_triple_buffer(name="shared_mem_frames", init_array=frame)
+    results = multiprocessing.Queue()
+    readers = [multiprocessing.Process(target=_frame_reader, args=("shared_mem_frames", results)) for _ in range(3)]
+    for reader in readers:
+        reader.start()
+    time.sleep(0.5)
+    t_start = time.perf_counter()
+    for i in range(120):
+        back = frames.back()
+        back[1:] = i % 256
+        back.reshape(-1)[:8].view(np.float64)[0] = time.perf_counter()  # timestamp in the first pixels
+        frames.publish()
+        time.sleep(max(0.0, t_start + (i + 1) / 60 - time.perf_counter()))
+    time.sleep(0.1)
+    frames.write(np.full_like(frame, 255))  # stop signal
+    for reader in readers:
+        n_frames, n_torn, latency = results.get()
+        print(f"\tReader: {n_frames} frames, {n_torn} overwritten while viewed, latency p50 {latency*1e6:.0f} us")
+        reader.join()
+    frames.close_link()
+    frames.delete_memory()
@@ -16,6 +16,7 @@ from typing import Optional, Tuple
 import collections
 
 SET_RUNTIME = True
+READ_RETRIES = 10 # refresh attempts to read the buffers while they aren't being written
 
 class Line():
     def __init__(self, buff_sz=100, name=None, color='b'):
@@ -24,10 +25,15 @@ class Line():
         self.curve = None
         self.color = color
 
-        # multi-process buffers shared between processes for hosting displayed data
-        # buffers can be safely accessed from multiple processes
-        self.x = Array('d', self.buff_sz)
-        self.y = Array('d', self.buff_sz)
+        # views of this line's data in the buffer shared by all lines of the plot (see SRV)
+        self.x = None
+        self.y = None
+
+    # views are remapped on the shared buffer after unpickling (see SRV)
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['x'] = state['y'] = None
+        return state
 
 
 # Simple Remote Viz
@@ -65,19 +71,48 @@ class SRV():
         self.buff_idx = 0
         self.n_lines = 0
         self.legends = []
+        self.line_ids = {}
         self.lines = collections.OrderedDict()
         assert type(legends) is tuple, "legends should be a tuple:"+legends
         for i, legend in enumerate(legends):
             print("Adding lines", i, legend)
             self.add_line(buff_sz, legend, pg.intColor(i))
+
+        # multi-process buffer shared between processes for hosting displayed data
+        # x and y of all lines in one lock free block, so that samples of all lines are written with one copy
+        # consistency comes from the sequence counter instead: odd while the buffer is being written
+        self.buffer = Array('d', 2*self.n_lines*self.buff_sz, lock=False)
+        self.seq_buffer = Array('Q', 1, lock=False)
+        self.map_buffers()
+
         # start the process
         self.start()
 
     def add_line(self, buff_sz, legend, color='g'):
+        assert buff_sz == self.buff_sz, "Invalid buff_sz {}, lines share the plot's buffer".format(buff_sz)
         self.lines[legend] = Line(buff_sz=buff_sz, name=legend, color=color)
+        self.line_ids[legend] = self.n_lines
         self.n_lines += 1
         self.legends.append(legend)
 
+    # numpy views of the shared buffers. data: (x/y, n_lines, buff_sz)
+    def map_buffers(self):
+        self.data = np.frombuffer(self.buffer).reshape(2, self.n_lines, self.buff_sz)
+        self.seq = np.frombuffer(self.seq_buffer, dtype=np.uint64)
+        for line_id, line in enumerate(self.lines.values()):
+            line.x = self.data[0, line_id]
+            line.y = self.data[1, line_id]
+
+    # numpy views pickle as copies (spawn start method): they are remapped on the shared buffers instead
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['data'] = state['seq'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.map_buffers()
+
     # start child process for rendering
     def start(self):
         # self.run()
@@ -91,29 +126,41 @@ class SRV():
     # Append new data to the cyclic buffer.
     # indexed with keys order; legends order if None
     def append(self, x_data=None, y_data=None, keys=None):
-        self.data_cnt += 1
-        if keys is None:
-            keys = self.legends
+        assert y_data is not None, "y_data can't be none."
+        if x_data is not None:
+            x_data = np.reshape(x_data, (1, -1))
+        self.append_many(x_data=x_data, y_data=np.reshape(y_data, (1, -1)), keys=keys)
 
+    # Append a block of samples of all lines to the cyclic buffer, with one vectorized copy.
+    # y_data: (n_samples, n_keys), indexed with keys order; legends order if None
+    # x_data: (n_samples, n_keys), (n_samples,) shared by all lines, or None for incremental indexes
+    def append_many(self, x_data=None, y_data=None, keys=None):
         assert y_data is not None, "y_data can't be none."
+        line_ids = slice(None) if keys is None else np.array([self.line_ids[key] for key in keys])
+        n_keys = self.n_lines if keys is None else len(keys)
+        y_data = np.asarray(y_data, dtype=np.float64).reshape(-1, n_keys)
+        n_samples = y_data.shape[0]
+        if n_samples == 0: # nothing new this tick
+            return
         if x_data is None:
-            if np.isscalar(y_data):
-                x_data = self.data_cnt
-            else:
-                x_data = self.data_cnt * np.ones_like(y_data)
-
-        if self.n_lines>1:
-            for data_id, key in enumerate(keys):
-                self.lines[key].x[self.buff_idx] = x_data[data_id]
-                self.lines[key].y[self.buff_idx] = y_data[data_id]
+            x_data = self.data_cnt + np.arange(1, n_samples+1, dtype=np.float64)
+        x_data = np.asarray(x_data, dtype=np.float64).reshape(n_samples, -1)
+        self.data_cnt += n_samples
+
+        # newest samples that fit: one slot stays NaN, to separate the newest sample from the oldest
+        n_kept = min(n_samples, self.buff_sz-1)
+        if self.buff_idx+n_kept <= self.buff_sz:
+            buff_ids = slice(self.buff_idx, self.buff_idx+n_kept)
         else:
-            self.lines[keys[0]].x[self.buff_idx] = x_data
-            self.lines[keys[0]].y[self.buff_idx] = y_data
-        self.buff_idx = 0 if (self.buff_idx==self.buff_sz-1) else self.buff_idx+1
+            buff_ids = (self.buff_idx + np.arange(n_kept)) % self.buff_sz
+        index = np.ix_(line_ids, buff_ids) if keys is not None and type(buff_ids) is not slice else (line_ids, buff_ids)
+        self.buff_idx = (self.buff_idx+n_kept) % self.buff_sz
 
-        for data_id, key in enumerate(keys):
-            self.lines[key].x[self.buff_idx] = np.nan
-            self.lines[key].y[self.buff_idx] = np.nan
+        self.seq[0] += 1 # odd: being written
+        self.data[0][index] = x_data[n_samples-n_kept:].T
+        self.data[1][index] = y_data[n_samples-n_kept:].T
+        self.data[:, line_ids, self.buff_idx] = np.nan
+        self.seq[0] += 1
 
     # Update entire buffer
     def update(self, key, x_data=None, y_data=None):
@@ -122,6 +169,8 @@ class SRV():
         if x_data is None and y_data is None: # clear both
             x_data = y_data = 0
 
+        self.seq[0] += 1 # odd: being written
+
         # update x
         if x_data is not None:
             if np.isscalar(x_data):
@@ -139,6 +188,7 @@ class SRV():
                 n_data = len(y_data)
                 self.lines[key].y[:n_data] = y_data[:]
                 self.lines[key].y[n_data:] = np.zeros(self.lines[key].buff_sz-n_data)
+        self.seq[0] += 1
 
         self.data_cnt += self.lines[key].buff_sz
 
@@ -155,10 +205,24 @@ class SRV():
 
         self.data_cnt = 0
 
+    # consistent copy of the buffers (None if they kept being written), data: (x/y, n_lines, buff_sz)
+    def read(self):
+        for _ in range(READ_RETRIES):
+            seq = int(self.seq[0])
+            if seq % 2 == 0:
+                data = self.data.copy()
+                if int(self.seq[0]) == seq:
+                    return data
+            time.sleep(0)
+        return None
+
     # refresh plot with new data
     def refresh(self):
-        for legend, line in self.lines.items():
-            line.curve.setData(line.x[:], line.y[:])
+        data = self.read()
+        if data is None:
+            return # try again on the next refresh
+        for line_id, line in enumerate(self.lines.values()):
+            line.curve.setData(data[0, line_id], data[1, line_id])
 
     # Run viewer
     def run(self):
@@ -202,13 +266,16 @@ class SRV():
         app.exec_()
 
 if __name__ == '__main__':
-    def io(running, srv1, srv2):
+    def io(running, srv1, srv2, srv3):
         t = 0.
         while running.is_set():
             s = np.sin(2 * np.pi * t)
-            t += 0.01
             srv1.append(y_data=s) # used incremental indexes for X
-            srv2.append([t, t],[s, -s-1])
+            srv2.append([t+.01, t+.01],[s, -s-1])
+            # 10 samples (1kHz) of 20 lines at once
+            tt = t + np.arange(1, 11)/1000
+            srv3.append_many(tt, np.sin(2 * np.pi * tt[:, None] + np.arange(20)/4))
+            t += 0.01
             time.sleep(.01)
         print("Done")
 
@@ -231,6 +298,10 @@ if __name__ == '__main__':
     srv2 = SRV(fig_name="SRV Example-2", buff_sz=sz,
                 legends=("srv2:line1", "srv2:line2"), plot_name="Demo plot-2")
 
+    # create a third plot, with many lines appended in blocks
+    srv3 = SRV(fig_name="SRV Example-3", buff_sz=sz, markers=None,
+                legends=tuple("srv3:line{}".format(i) for i in range(20)), plot_name="Demo plot-3")
+
     # create static buffer and update plot
     xx_buff = np.array(range(sz))/100
     yy_buff = np.sin(xx_buff)
@@ -249,7 +320,7 @@ if __name__ == '__main__':
     time.sleep(1)
 
     # start IO thread
-    t = threading.Thread(target=io, args=(run, srv1, srv2))
+    t = threading.Thread(target=io, args=(run, srv1, srv2, srv3))
     t.start()
 
     input("Type Enter to quit.")
@@ -259,4 +330,5 @@ if __name__ == '__main__':
     print("Close all graphs now. \nWaiting for graph window process to join...")
     srv1.close()
     srv2.close()
+    srv3.close()
     print("All process joined successfully.")
\ No newline at end of file
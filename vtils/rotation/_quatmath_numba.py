@@ -0,0 +1,201 @@
+"""
+Numba compiled kernels for vtils.rotation.quatmath.
+Kernels work on flattened batches: inputs (n, ...) and preallocated outputs (n, ...).
+Compiled code is cached to disk (cache=True), so only the very first run pays for compilation.
+Import fails with ImportError if numba isn't installed; quatmath then stays on numpy.
+"""
+import math
+
+import numba
+
+_jit = numba.njit(cache=True, nogil=True)
+
+
+@_jit
+def euler2mat(euler, mat):
+    for i in range(euler.shape[0]):
+        ai, aj, ak = -euler[i, 2], -euler[i, 1], -euler[i, 0]
+        si, sj, sk = math.sin(ai), math.sin(aj), math.sin(ak)
+        ci, cj, ck = math.cos(ai), math.cos(aj), math.cos(ak)
+        cc, cs = ci * ck, ci * sk
+        sc, ss = si * ck, si * sk
+
+        mat[i, 2, 2] = cj * ck
+        mat[i, 2, 1] = sj * sc - cs
+        mat[i, 2, 0] = sj * cc + ss
+        mat[i, 1, 2] = cj * sk
+        mat[i, 1, 1] = sj * ss + cc
+        mat[i, 1, 0] = sj * cs - sc
+        mat[i, 0, 2] = -sj
+        mat[i, 0, 1] = cj * si
+        mat[i, 0, 0] = cj * ci
+
+
+@_jit
+def euler2quat(euler, quat):
+    for i in range(euler.shape[0]):
+        ai, aj, ak = euler[i, 2] / 2, -euler[i, 1] / 2, euler[i, 0] / 2
+        si, sj, sk = math.sin(ai), math.sin(aj), math.sin(ak)
+        ci, cj, ck = math.cos(ai), math.cos(aj), math.cos(ak)
+        cc, cs = ci * ck, ci * sk
+        sc, ss = si * ck, si * sk
+
+        quat[i, 0] = cj * cc + sj * ss
+        quat[i, 3] = cj * sc - sj * cs
+        quat[i, 2] = -(cj * ss + sj * cc)
+        quat[i, 1] = cj * cs - sj * sc
+
+
+@_jit
+def mat2euler(mat, euler, eps4):
+    for i in range(mat.shape[0]):
+        cy = math.sqrt(mat[i, 2, 2] * mat[i, 2, 2] + mat[i, 1, 2] * mat[i, 1, 2])
+        if cy > eps4:
+            euler[i, 2] = -math.atan2(mat[i, 0, 1], mat[i, 0, 0])
+            euler[i, 0] = -math.atan2(mat[i, 1, 2], mat[i, 2, 2])
+        else:
+            euler[i, 2] = -math.atan2(-mat[i, 1, 0], mat[i, 1, 1])
+            euler[i, 0] = 0.0
+        euler[i, 1] = -math.atan2(-mat[i, 0, 2], cy)
+
+
+@_jit
+def quat2mat(quat, mat, eps):
+    for i in range(quat.shape[0]):
+        w, x, y, z = quat[i, 0], quat[i, 1], quat[i, 2], quat[i, 3]
+        Nq = w * w + x * x + y * y + z * z
+        if not Nq > eps:
+            for r in range(3):
+                for c in range(3):
+                    mat[i, r, c] = 1.0 if r == c else 0.0
+            continue
+        s = 2.0 / Nq
+        X, Y, Z = x * s, y * s, z * s
+        wX, wY, wZ = w * X, w * Y, w * Z
+        xX, xY, xZ = x * X, x * Y, x * Z
+        yY, yZ, zZ = y * Y, y * Z, z * Z
+
+        mat[i, 0, 0] = 1.0 - (yY + zZ)
+        mat[i, 0, 1] = xY - wZ
+        mat[i, 0, 2] = xZ + wY
+        mat[i, 1, 0] = xY + wZ
+        mat[i, 1, 1] = 1.0 - (xX + zZ)
+        mat[i, 1, 2] = yZ - wX
+        mat[i, 2, 0] = xZ - wY
+        mat[i, 2, 1] = yZ + wX
+        mat[i, 2, 2] = 1.0 - (xX + yY)
+
+
+@_jit
+def quat2euler(quat, euler, eps):
+    for i in range(quat.shape[0]):
+        w, x, y, z = quat[i, 0], quat[i, 1], quat[i, 2], quat[i, 3]
+        Nq = w * w + x * x + y * y + z * z
+        if not Nq > eps:
+            euler[i, 0] = euler[i, 1] = euler[i, 2] = 0.0
+            continue
+        s = 2.0 / Nq
+        X, Y, Z = x * s, y * s, z * s
+        m02 = x * Z + w * Y
+        m12 = y * Z - w * X
+        m22 = 1.0 - (x * X + y * Y)
+
+        cy = math.sqrt(m22 * m22 + m12 * m12)
+        if cy > 4.0 * eps:
+            euler[i, 2] = -math.atan2(x * Y - w * Z, 1.0 - (y * Y + z * Z))
+            euler[i, 0] = -math.atan2(m12, m22)
+        else:
+            euler[i, 2] = -math.atan2(-(x * Y + w * Z), 1.0 - (x * X + z * Z))
+            euler[i, 0] = 0.0
+        euler[i, 1] = -math.atan2(-m02, cy)
+
+
+@_jit
+def mat2quat(mat, quat):
+    for i in range(mat.shape[0]):
+        m00, m01, m02 = mat[i, 0, 0], mat[i, 0, 1], mat[i, 0, 2]
+        m10, m11, m12 = mat[i, 1, 0], mat[i, 1, 1], mat[i, 1, 2]
+        m20, m21, m22 = mat[i, 2, 0], mat[i, 2, 1], mat[i, 2, 2]
+        # Shepperd: pick the row of 4*q*q^T with the largest diagonal
+        d0 = 1.0 + m00 + m11 + m22
+        d1 = 1.0 + m00 - m11 - m22
+        d2 = 1.0 - m00 + m11 - m22
+        d3 = 1.0 - m00 - m11 + m22
+        if d0 >= d1 and d0 >= d2 and d0 >= d3:
+            w, x, y, z = d0, m21 - m12, m02 - m20, m10 - m01
+        elif d1 >= d2 and d1 >= d3:
+            w, x, y, z = m21 - m12, d1, m10 + m01, m20 + m02
+        elif d2 >= d3:
+            w, x, y, z = m02 - m20, m10 + m01, d2, m21 + m12
+        else:
+            w, x, y, z = m10 - m01, m20 + m02, m21 + m12, d3
+        norm = math.sqrt(w * w + x * x + y * y + z * z)
+        # Prefer quaternion with positive w
+        if w < 0:
+            norm = -norm
+        quat[i, 0] = w / norm
+        quat[i, 1] = x / norm
+        quat[i, 2] = y / norm
+        quat[i, 3] = z / norm
+
+
+@_jit
+def mulQuat(qa, qb, res):
+    for i in range(qa.shape[0]):
+        aw, ax, ay, az = qa[i, 0], qa[i, 1], qa[i, 2], qa[i, 3]
+        bw, bx, by, bz = qb[i, 0], qb[i, 1], qb[i, 2], qb[i, 3]
+        res[i, 0] = aw*bw - ax*bx - ay*by - az*bz
+        res[i, 1] = aw*bx + ax*bw + ay*bz - az*by
+        res[i, 2] = aw*by - ax*bz + ay*bw + az*bx
+        res[i, 3] = aw*bz + ax*by - ay*bx + az*bw
+
+
+@_jit
+def quat2Vel(quat, dt, speed, axis):
+    for i in range(quat.shape[0]):
+        sin_a_2 = math.sqrt(quat[i, 1] * quat[i, 1] + quat[i, 2] * quat[i, 2] + quat[i, 3] * quat[i, 3])
+        for j in range(3):
+            axis[i, j] = quat[i, j + 1] / (sin_a_2 + 1e-8)
+        speed[i] = 2 * math.atan2(sin_a_2, quat[i, 0]) / dt
+
+
+if __name__ == '__main__':
+    # Parity check: numba and numpy backends should agree
+    import numpy as np
+    from vtils.rotation import quatmath
+
+    rng = np.random.default_rng(0)
+    euler = rng.uniform(-np.pi, np.pi, size=(1000, 3))
+    euler[:10, 1] = np.pi / 2  # gimbal lock
+    quat = rng.normal(size=(1000, 4))
+    quat[0] = 0.0  # degenerate quaternion
+    mat = quatmath.euler2mat(euler)
+    cases = {
+        "euler2mat": lambda x: quatmath.euler2mat(x, dtype=None),
+        "euler2quat": lambda x: quatmath.euler2quat(x, dtype=None),
+        "mat2euler": lambda x: quatmath.mat2euler(x, dtype=None),
+        "quat2mat": lambda x: quatmath.quat2mat(x, dtype=None),
+        "quat2euler": lambda x: quatmath.quat2euler(x, dtype=None),
+        "mat2quat": quatmath.mat2quat,
+        "mulQuat": lambda x: quatmath.mulQuat(x, x[::-1]),
+        "quat2Vel": lambda x: np.concatenate([np.asarray(v).reshape(x.shape[:-1] + (-1,)) for v in quatmath.quat2Vel(x, 0.1)], axis=-1),
+    }
+    inputs = {"euler2mat": euler, "euler2quat": euler, "mat2euler": mat, "mat2quat": mat,
+              "quat2mat": quat, "quat2euler": quat, "mulQuat": quat, "quat2Vel": quat}
+
+    failed = False
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for name, fn in cases.items():
+            for dtype, tol in ((np.float64, 1e-12), (np.float32, 1e-5)):
+                x = inputs[name].astype(dtype)
+                for shape in ((), (7,), (1000,)):
+                    xs = x[0] if shape == () else x[:shape[0]]
+                    quatmath.set_backend("numpy")
+                    ref = fn(xs)
+                    quatmath.set_backend("numba")
+                    res = fn(xs)
+                    ok = res.dtype == ref.dtype and res.shape == ref.shape and np.allclose(res, ref, atol=tol, rtol=0)
+                    failed |= not ok
+                    print(f"{'ok  ' if ok else 'FAIL'} {name:<12} {np.dtype(dtype).name:<8} batch:{shape}")
+    print("Parity FAILED" if failed else "Parity OK")
+    raise SystemExit(int(failed))
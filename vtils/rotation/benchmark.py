@@ -0,0 +1,161 @@
+DESC = """Benchmark suite for vtils.rotation.quatmath
+
+Times every public conversion and quaternion op over batch sizes and dtypes,
+reporting ns/element and peak memory. Results can be saved as a baseline JSON,
+and later runs compared against it; a slowdown beyond the tolerance fails (exit code 1).
+
+Examples:
+    python -m vtils.rotation.benchmark --save baseline.json
+    python -m vtils.rotation.benchmark --compare baseline.json --tolerance 1.3
+"""
+
+import json
+import platform
+import time
+import tracemalloc
+
+import click
+import numpy as np
+
+from vtils.rotation import quatmath
+
+BATCH_SIZES = (1, 10, 100, 1000, 10000, 100000, 1000000)
+DTYPES = ("float32", "float64")
+
+
+def _inputs(n, dtype, rng):
+    """ Valid inputs of each representation for a batch of n (n=1 benchmarks the unbatched call) """
+    shape = () if n == 1 else (n,)
+    euler = rng.uniform(-np.pi, np.pi, size=shape + (3,)).astype(dtype)
+    quat = quatmath.euler2quat(euler, dtype=None)
+    return {
+        "euler": euler,
+        "quat": quat,
+        "quat2": quat[..., [0, 2, 3, 1]],
+        "mat": quatmath.euler2mat(euler, dtype=None),
+        "axis": (quat[..., 1:] / np.linalg.norm(quat[..., 1:], axis=-1, keepdims=True)).astype(dtype),
+        "angle": euler[..., 0],
+    }
+
+
+# name: (function, input names)
+CASES = {
+    "euler2mat": (lambda x: quatmath.euler2mat(x, dtype=None), ("euler",)),
+    "euler2quat": (lambda x: quatmath.euler2quat(x, dtype=None), ("euler",)),
+    "mat2euler": (lambda x: quatmath.mat2euler(x, dtype=None), ("mat",)),
+    "quat2mat": (lambda x: quatmath.quat2mat(x, dtype=None), ("quat",)),
+    "quat2euler": (lambda x: quatmath.quat2euler(x, dtype=None), ("quat",)),
+    "mat2quat": (quatmath.mat2quat, ("mat",)),
+    "mat2quat_robust": (lambda x: quatmath.mat2quat(x, robust=True), ("mat",)),
+    "mulQuat": (quatmath.mulQuat, ("quat", "quat2")),
+    "negQuat": (quatmath.negQuat, ("quat",)),
+    "quat2Vel": (quatmath.quat2Vel, ("quat",)),
+    "quatDiff2Vel": (lambda q1, q2: quatmath.quatDiff2Vel(q1, q2, 0.01), ("quat", "quat2")),
+    "axis_angle2quat": (quatmath.axis_angle2quat, ("axis", "angle")),
+    "quat2axis_angle": (quatmath.quat2axis_angle, ("quat",)),
+    "quat_log": (quatmath.quat_log, ("quat",)),
+    "quat_exp": (quatmath.quat_exp, ("euler",)),
+    "quat_rotate": (lambda q, v: quatmath.quat_rotate(q, v, dtype=None), ("quat", "euler")),
+}
+
+
+def time_call(fn, args, min_time=0.05, repeats=5):
+    """ Best of repeats, each averaging enough calls to last ~min_time. Returns seconds/call """
+    fn(*args)  # warm up (jit, workspaces)
+    t_start = time.perf_counter()
+    fn(*args)
+    t_call = max(time.perf_counter() - t_start, 1e-9)
+    number = max(1, int(min_time / t_call))
+    best = np.inf
+    for _ in range(repeats):
+        t_start = time.perf_counter()
+        for _ in range(number):
+            fn(*args)
+        best = min(best, (time.perf_counter() - t_start) / number)
+    return best
+
+
+def peak_memory(fn, args):
+    """ Peak bytes allocated (numpy buffers included) during one call """
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    fn(*args)
+    peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return peak
+
+
+def run(cases=None, batch_sizes=BATCH_SIZES, dtypes=DTYPES, min_time=0.05, verbose=True):
+    """ Run the benchmarks. Returns a report dict with results keyed as name/dtype/batch """
+    rng = np.random.default_rng(0)
+    cases = cases or tuple(CASES.keys())
+    report = {
+        "meta": {
+            "numpy": np.__version__,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "backend": quatmath.get_backend(),
+        },
+        "results": {},
+    }
+    for dtype in dtypes:
+        for n in batch_sizes:
+            inputs = _inputs(n, dtype, rng)
+            for name in cases:
+                fn, arg_names = CASES[name]
+                args = tuple(inputs[arg] for arg in arg_names)
+                with np.errstate(all="ignore"):
+                    t_call = time_call(fn, args, min_time=min_time)
+                    peak = peak_memory(fn, args)
+                key = f"{name}/{dtype}/{n}"
+                report["results"][key] = {"ns_per_elem": t_call * 1e9 / n, "peak_bytes": peak}
+                if verbose:
+                    print(f"{key:<32} {t_call*1e9/n:12.1f} ns/elem {peak/1024:12.1f} KiB peak")
+    return report
+
+
+def compare(report, baseline, tolerance=1.3, min_ns=0.0):
+    """ Compare a report against a baseline report. Returns list of (key, baseline ns, current ns) regressions """
+    regressions = []
+    for key, res in report["results"].items():
+        if key not in baseline["results"]:
+            continue
+        base_ns = baseline["results"][key]["ns_per_elem"]
+        if res["ns_per_elem"] > tolerance * base_ns and res["ns_per_elem"] - base_ns > min_ns:
+            regressions.append((key, base_ns, res["ns_per_elem"]))
+    return regressions
+
+
+@click.command(help=DESC)
+@click.option('-c', '--cases', multiple=True, type=click.Choice(list(CASES.keys())), help='Cases to run (default: all)')
+@click.option('-n', '--batch_sizes', multiple=True, type=int, default=BATCH_SIZES, help='Batch sizes')
+@click.option('-d', '--dtypes', multiple=True, type=click.Choice(DTYPES), default=DTYPES, help='dtypes')
+@click.option('-b', '--backend', type=click.Choice(["auto", "numpy", "numba"]), default="auto", help='quatmath backend')
+@click.option('-t', '--min_time', type=float, default=0.05, help='Seconds spent per timing repeat')
+@click.option('-s', '--save', type=click.Path(), default=None, help='Save report as JSON')
+@click.option('-cmp', '--compare', 'baseline_path', type=click.Path(exists=True), default=None, help='Baseline JSON to compare against')
+@click.option('-tol', '--tolerance', type=float, default=1.3, help='Allowed slowdown ratio vs the baseline')
+def main(cases, batch_sizes, dtypes, backend, min_time, save, baseline_path, tolerance):
+    if backend != "auto":
+        quatmath.set_backend(backend)
+    report = run(cases=cases, batch_sizes=batch_sizes, dtypes=dtypes, min_time=min_time)
+
+    if save:
+        with open(save, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report saved to {save}")
+
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, tolerance=tolerance)
+        for key, base_ns, ns in regressions:
+            print(f"REGRESSION {key}: {base_ns:.1f} -> {ns:.1f} ns/elem ({ns/base_ns:.2f}x)")
+        if regressions:
+            raise SystemExit(1)
+        print(f"No regressions beyond {tolerance}x of {baseline_path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+import numpy as np
+
+from vtils.rotation.quatmath import quatDiff2Vel
+
+# Below this sin(angle) between keyframes, slerp falls back to (normalized) lerp
+_SLERP_EPS = 1e-6
+
+
+def _shortest_arc(q0, q1):
+    """ Flip q1 onto the hemisphere of q0. Returns flipped q1 and the clipped dot(q0, q1) """
+    dot = np.sum(q0 * q1, axis=-1)
+    flip = dot < 0
+    q1 = np.where(flip[..., np.newaxis], -q1, q1)
+    dot = np.clip(np.abs(dot), 0.0, 1.0)
+    return q1, dot
+
+
+def _slerp_weights(theta, t):
+    """ slerp weights for q0, q1. Small angles use linear weights """
+    sin_theta = np.sin(theta)
+    small = sin_theta < _SLERP_EPS
+    sin_theta = np.where(small, 1.0, sin_theta)
+    w0 = np.where(small, 1.0 - t, np.sin((1.0 - t) * theta) / sin_theta)
+    w1 = np.where(small, t, np.sin(t * theta) / sin_theta)
+    return w0, w1
+
+
+def _blend(q0, q1, w0, w1, normalize):
+    quat = q0 * w0[..., np.newaxis]
+    quat += q1 * w1[..., np.newaxis]
+    if normalize:
+        quat /= np.linalg.norm(quat, axis=-1, keepdims=True)
+    return quat
+
+
+def slerp(q0, q1, t, shortest=True):
+    """ Spherical linear interpolation between quaternions q0, q1 (..., 4) at fractions t (...)
+    Inputs broadcast. With shortest=True, q1 is flipped to take the shorter arc.
+    """
+    q0 = np.asarray(q0, dtype=np.float64)
+    q1 = np.asarray(q1, dtype=np.float64)
+    t = np.asarray(t, dtype=np.float64)
+    assert q0.shape[-1] == 4 and q1.shape[-1] == 4, "Invalid shape quats {}, {}".format(q0, q1)
+
+    if shortest:
+        q1, dot = _shortest_arc(q0, q1)
+    else:
+        dot = np.clip(np.sum(q0 * q1, axis=-1), -1.0, 1.0)
+    w0, w1 = _slerp_weights(np.arccos(dot), t)
+    return _blend(q0, q1, w0, w1, normalize=True)
+
+
+def nlerp(q0, q1, t, shortest=True):
+    """ Normalized linear interpolation between quaternions q0, q1 (..., 4) at fractions t (...)
+    Cheaper than slerp, but does not have constant angular velocity.
+    """
+    q0 = np.asarray(q0, dtype=np.float64)
+    q1 = np.asarray(q1, dtype=np.float64)
+    t = np.asarray(t, dtype=np.float64)
+    assert q0.shape[-1] == 4 and q1.shape[-1] == 4, "Invalid shape quats {}, {}".format(q0, q1)
+
+    if shortest:
+        q1, _ = _shortest_arc(q0, q1)
+    return _blend(q0, q1, 1.0 - t, t, normalize=True)
+
+
+class QuatInterpolator():
+    """
+    Interpolate a quaternion trajectory given at keyframe times.
+    Per segment quantities are computed once, so that queries only pay for
+    a searchsorted, a gather and the interpolation weights.
+    """
+    def __init__(self, key_times, key_quats, method="slerp"):
+        """
+        Args:
+            key_times (N,): strictly non-decreasing keyframe timestamps
+            key_quats (N, ..., 4): keyframe quaternions (w, x, y, z)
+            method: "slerp" or "nlerp"
+        """
+        self.key_times = np.asarray(key_times, dtype=np.float64)
+        self.key_quats = np.asarray(key_quats, dtype=np.float64)
+        assert self.key_times.ndim == 1, "key_times should be 1D {}".format(self.key_times.shape)
+        assert self.key_quats.shape[0] == self.key_times.shape[0] and self.key_quats.shape[-1] == 4, \
+            "Invalid shape key_quats {}".format(self.key_quats.shape)
+        assert self.key_times.shape[0] >= 2, "Need at least 2 keyframes"
+        assert method in ("slerp", "nlerp"), "Unknown method {}".format(method)
+        self.method = method
+
+        # Per segment start, shortest arc end, and angle
+        self.q0 = self.key_quats[:-1]
+        self.q1, dot = _shortest_arc(self.q0, self.key_quats[1:])
+        self.theta = np.arccos(dot)
+        self.seg_dt = np.diff(self.key_times)
+
+    def segment(self, query_times):
+        """ Segment index and in-segment fraction [0, 1] of the query times. Out of range queries are held at the ends """
+        query_times = np.asarray(query_times, dtype=np.float64)
+        idx = np.searchsorted(self.key_times, query_times, side="right") - 1
+        idx = np.clip(idx, 0, self.seg_dt.shape[0] - 1)  # searchsorted returns a scalar for a scalar query
+        seg_dt = self.seg_dt[idx]
+        t = np.ones_like(query_times)
+        np.divide(query_times - self.key_times[idx], seg_dt, out=t, where=seg_dt > 0)
+        np.clip(t, 0.0, 1.0, out=t)
+        return idx, t
+
+    def __call__(self, query_times):
+        """ Quaternions (Q..., ..., 4) at query_times (Q...) """
+        idx, t = self.segment(query_times)
+        # align t with the keyframe batch dims
+        t = t.reshape(t.shape + (1,) * (self.key_quats.ndim - 2))
+        q0, q1 = self.q0[idx], self.q1[idx]
+        if self.method == "slerp":
+            w0, w1 = _slerp_weights(self.theta[idx], t)
+        else:
+            w0, w1 = np.broadcast_to(1.0 - t, q0.shape[:-1]), np.broadcast_to(t, q0.shape[:-1])
+        return _blend(q0, q1, w0, w1, normalize=True)
+
+    def velocity(self, query_times):
+        """ Angular speed (Q..., ...) and axis (Q..., ..., 3) at query_times, see quatmath.quat2Vel """
+        idx, _ = self.segment(query_times)
+        seg_dt = np.where(self.seg_dt > 0, self.seg_dt, np.inf)
+        seg_dt = seg_dt.reshape(seg_dt.shape + (1,) * (self.key_quats.ndim - 2))
+        speed, axis = quatDiff2Vel(self.q0, self.q1, seg_dt)
+        return speed[idx], axis[idx]
+
+
+def interp_quat(key_times, key_quats, query_times, method="slerp"):
+    """ Resample a quaternion trajectory (key_times, key_quats) at query_times. See QuatInterpolator """
+    return QuatInterpolator(key_times, key_quats, method=method)(query_times)
+
+
+if __name__ == '__main__':
+    import time
+    from vtils.rotation.quatmath import euler2quat
+
+    # Resample a 100 Hz orientation stream onto 1e6 controller timestamps
+    key_times = np.arange(0, 10, 0.01)
+    key_quats = euler2quat(np.stack([np.sin(key_times), np.cos(key_times), key_times], axis=-1))
+    query_times = np.sort(np.random.uniform(0, 10, size=1000000))
+
+    for method in ("slerp", "nlerp"):
+        interp = QuatInterpolator(key_times, key_quats, method=method)
+        t_start = time.time()
+        quats = interp(query_times)
+        print(f"{method}: {quats.shape[0]} queries in {(time.time()-t_start)*1e3:.1f} ms")
+
+    speed, axis = interp.velocity(query_times[:3])
+    print(f"Angular speed: {speed}, axis: {axis}")
@@ -1,106 +1,463 @@
+import math
+import os
+import threading
+
 import numpy as np
+
+# Optional compiled backend, used automatically when numba is installed.
+# Set VTILS_ROTATION_BACKEND=numpy (or call set_backend) to force the numpy code.
+try:
+    from vtils.rotation import _quatmath_numba
+except ImportError:
+    _quatmath_numba = None
 # For testing whether a number is close to zero
 _FLOAT_EPS = np.finfo(np.float64).eps
 _EPS4 = _FLOAT_EPS * 4.0
+_FLOAT32_EPS = np.finfo(np.float32).eps
+_EYE3 = np.eye(3)
+# Below this sin(angle/2), quat_log/quat_exp switch to small angle series
+_SMALL_ANGLE = 1e-4
+
+# Scratch arrays are cached (per thread) only for batches up to this many elements
+_WORKSPACE_MAX_SIZE = 4096
+_WORKSPACE = threading.local()
+
+
+def _workspace(key, shape, dtype, n):
+    """ Return n scratch arrays of shape/dtype, reused across calls for small batches.
+    Each (key, dtype) keeps one buffer of _WORKSPACE_MAX_SIZE elements per array, and views of it
+    for the last shape, so the memory retained doesn't grow with the number of batch sizes seen.
+    """
+    size = math.prod(shape)
+    if size > _WORKSPACE_MAX_SIZE:
+        ws = np.empty((n,) + shape, dtype=dtype)
+        return tuple(ws[i, ...] for i in range(n))
+    cache = _WORKSPACE.__dict__
+    buffer, last_shape, ws = cache.get((key, dtype, n), (None, None, None))
+    if buffer is None:
+        buffer = np.empty((n, _WORKSPACE_MAX_SIZE), dtype=dtype)
+    if last_shape != shape:
+        ws = tuple(buffer[i, :size].reshape(shape) for i in range(n))
+        cache[(key, dtype, n)] = (buffer, shape, ws)
+    return ws
+
+
+def _as_float_array(x, dtype, out):
+    """ Cast input to the working dtype (out.dtype > dtype > input float dtype) """
+    if out is not None:
+        dtype = out.dtype
+    elif dtype is None:
+        x = np.asarray(x)
+        dtype = x.dtype if x.dtype.char in 'fd' else np.float64
+    return np.asarray(x, dtype=dtype)
+
+
+def _output(out, shape, dtype):
+    """ Validate the user provided output buffer, or allocate a new one """
+    if out is None:
+        return np.empty(shape, dtype=dtype)
+    assert out.shape == shape, "Invalid shape out {}, expected {}".format(out.shape, shape)
+    return out
+
+
+# NOTE: negation of strided views below uses np.multiply(x, -1.0, out=...),
+# np.negative(x, out=...) gives wrong float32 results on some numpy releases (2.4).
+def _eps(dtype):
+    return _FLOAT32_EPS if dtype == np.float32 else _FLOAT_EPS
+
+
+def set_backend(name):
+    """ Select the backend ("numba" or "numpy") used by the conversions and quaternion algebra """
+    global _backend
+    assert name in ("numba", "numpy"), "Unknown backend {}".format(name)
+    if name == "numba" and _quatmath_numba is None:
+        raise ImportError("Vtils:> numba backend requested, but numba isn't installed")
+    _backend = _quatmath_numba if name == "numba" else None
+
+
+def get_backend():
+    return "numpy" if _backend is None else "numba"
+
+
+_backend = None
+if _quatmath_numba is not None and os.environ.get("VTILS_ROTATION_BACKEND", "numba") != "numpy":
+    _backend = _quatmath_numba
+
+
+def _use_backend(out):
+    """ Backend kernels write into flattened outputs, this needs a contiguous buffer.
+    Single elements are left to the math kernels below, which beat the jit dispatch cost.
+    """
+    return _backend is not None and out.flags.c_contiguous
 
 
 def mulQuat(qa, qb):
-    res = np.zeros(4)
-    res[0] = qa[0]*qb[0] - qa[1]*qb[1] - qa[2]*qb[2] - qa[3]*qb[3]
-    res[1] = qa[0]*qb[1] + qa[1]*qb[0] + qa[2]*qb[3] - qa[3]*qb[2]
-    res[2] = qa[0]*qb[2] - qa[1]*qb[3] + qa[2]*qb[0] + qa[3]*qb[1]
-    res[3] = qa[0]*qb[3] + qa[1]*qb[2] - qa[2]*qb[1] + qa[3]*qb[0]
+    """ Multiply Quaternions (qa * qb). Inputs broadcast over leading dims (..., 4) """
+    qa = np.asarray(qa, dtype=np.float64)
+    qb = np.asarray(qb, dtype=np.float64)
+    assert qa.shape[-1] == 4 and qb.shape[-1] == 4, "Invalid shape quats {}, {}".format(qa, qb)
+
+    aw, ax, ay, az = qa[..., 0], qa[..., 1], qa[..., 2], qa[..., 3]
+    bw, bx, by, bz = qb[..., 0], qb[..., 1], qb[..., 2], qb[..., 3]
+
+    res = np.empty(np.broadcast_shapes(qa.shape, qb.shape), dtype=np.float64)
+    if _backend is not None and qa.shape == qb.shape:
+        _backend.mulQuat(qa.reshape(-1, 4), qb.reshape(-1, 4), res.reshape(-1, 4))
+        return res
+    res[..., 0] = aw*bw - ax*bx - ay*by - az*bz
+    res[..., 1] = aw*bx + ax*bw + ay*bz - az*by
+    res[..., 2] = aw*by - ax*bz + ay*bw + az*bx
+    res[..., 3] = aw*bz + ax*by - ay*bx + az*bw
     return res
 
 def negQuat(quat):
-    return np.array([quat[0], -quat[1], -quat[2], -quat[3]])
+    """ Conjugate of Quaternions (..., 4) """
+    quat = np.asarray(quat, dtype=np.float64)
+    assert quat.shape[-1] == 4, "Invalid shape quat {}".format(quat)
+
+    res = np.negative(quat)
+    res[..., 0] = quat[..., 0]
+    return res
 
 def quat2Vel(quat, dt=1):
-    axis = quat[1:].copy()
-    sin_a_2 = np.sqrt(np.sum(axis**2))
-    axis = axis/(sin_a_2+1e-8)
-    speed = 2*np.arctan2(sin_a_2, quat[0])/dt
+    """ Convert Quaternions (..., 4) to angular speed (...) and axis (..., 3) """
+    quat = np.asarray(quat, dtype=np.float64)
+    assert quat.shape[-1] == 4, "Invalid shape quat {}".format(quat)
+
+    if _backend is not None and np.ndim(dt) == 0:
+        speed = np.empty(quat.shape[:-1], dtype=np.float64)
+        axis = np.empty(quat.shape[:-1] + (3,), dtype=np.float64)
+        _backend.quat2Vel(quat.reshape(-1, 4), float(dt), speed.reshape(-1), axis.reshape(-1, 3))
+        return (speed[()] if speed.ndim == 0 else speed), axis
+
+    axis = quat[..., 1:].copy()
+    sin_a_2 = np.sqrt(np.sum(axis**2, axis=-1))
+    axis /= (sin_a_2[..., np.newaxis]+1e-8)
+    speed = 2*np.arctan2(sin_a_2, quat[..., 0])/dt
     return speed, axis
 
 def quatDiff2Vel(quat1, quat2, dt):
+    """ Angular velocity taking quat1 to quat2 in time dt. Inputs broadcast over (..., 4) """
     neg = negQuat(quat1)
     diff = mulQuat(quat2, neg)
     return quat2Vel(diff, dt)
 
 
 def axis_angle2quat(axis, angle):
+    """ Convert axis (..., 3) and angle (...) to Quaternions (..., 4) """
+    axis = np.asarray(axis, dtype=np.float64)
+    angle = np.asarray(angle, dtype=np.float64)
+    assert axis.shape[-1] == 3, "Invalid shape axis {}".format(axis)
+
     c = np.cos(angle/2)
     s = np.sin(angle/2)
-    return np.array([c, s*axis[0], s*axis[1], s*axis[2]])
+    quat = np.empty(np.broadcast_shapes(axis.shape[:-1], angle.shape) + (4,), dtype=np.float64)
+    quat[..., 0] = c
+    quat[..., 1:] = s[..., np.newaxis]*axis
+    return quat
+
+
+def quat2axis_angle(quat):
+    """ Convert Quaternions (..., 4) to unit axis (..., 3) and angle (...) in [0, 2pi]
+    Zero rotations (undefined axis) return the x axis.
+    """
+    quat = np.asarray(quat, dtype=np.float64)
+    assert quat.shape[-1] == 4, "Invalid shape quat {}".format(quat)
+
+    sin_a_2 = np.linalg.norm(quat[..., 1:], axis=-1)
+    angle = 2*np.arctan2(sin_a_2, quat[..., 0])
+    # u/|u| stays accurate for tiny |u|, only exact zeros lack an axis
+    zero = ~(sin_a_2 > 0.0)
+    axis = quat[..., 1:] / np.where(zero, 1.0, sin_a_2)[..., np.newaxis]
+    axis[zero] = (1.0, 0.0, 0.0)
+    return axis, angle
 
-def euler2mat(euler):
-    """ Convert Euler Angles to Rotation Matrix.  See rotation.py for notes """
-    euler = np.asarray(euler, dtype=np.float64)
-    assert euler.shape[-1] == 3, "Invalid shaped euler {}".format(euler)
 
-    ai, aj, ak = -euler[..., 2], -euler[..., 1], -euler[..., 0]
-    si, sj, sk = np.sin(ai), np.sin(aj), np.sin(ak)
-    ci, cj, ck = np.cos(ai), np.cos(aj), np.cos(ak)
+def quat_log(quat):
+    """ Logarithm of (normalized) Quaternions (..., 4): the vector part, axis*angle/2 (..., 3)
+    quat_exp(quat_log(q)) == q for unit q, but q = -1 (its log has no direction: zero, the log of -q, is returned).
+    """
+    quat = np.asarray(quat, dtype=np.float64)
+    assert quat.shape[-1] == 4, "Invalid shape quat {}".format(quat)
+
+    w, vec = quat[..., 0], quat[..., 1:]
+    sin_a_2 = np.linalg.norm(vec, axis=-1)
+    # atan2(n, w)/n, with its series (1 - n^2/(3w^2))/w for small n. The series
+    # only holds near w = 1: near w = -1, atan2(n, w) ~ pi and is computed exactly
+    small = (sin_a_2 < _SMALL_ANGLE) & (w > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = np.where(small,
+                         (1.0 - sin_a_2**2/(3.0*w**2))/w,
+                         np.arctan2(sin_a_2, w)/np.where(small | (sin_a_2 == 0), 1.0, sin_a_2))
+    return vec * ratio[..., np.newaxis]
+
+
+def quat_exp(vec):
+    """ Exponential of pure Quaternions given by their vector part (..., 3). Returns unit Quaternions (..., 4) """
+    vec = np.asarray(vec, dtype=np.float64)
+    assert vec.shape[-1] == 3, "Invalid shape vec {}".format(vec)
+
+    norm = np.linalg.norm(vec, axis=-1)
+    small = norm < _SMALL_ANGLE
+    # sin(n)/n, with its series 1 - n^2/6 for small n
+    sinc = np.where(small, 1.0 - norm**2/6.0, np.sin(norm)/np.where(small, 1.0, norm))
+    quat = np.empty(vec.shape[:-1] + (4,), dtype=np.float64)
+    quat[..., 0] = np.cos(norm)
+    quat[..., 1:] = vec * sinc[..., np.newaxis]
+    return quat
+
+# Single element kernels. For one rotation, Python floats beat numpy dispatch and
+# avoid allocating any intermediate arrays.
+def _euler2mat_single(euler, mat):
+    ai, aj, ak = -euler[2], -euler[1], -euler[0]
+    si, sj, sk = math.sin(ai), math.sin(aj), math.sin(ak)
+    ci, cj, ck = math.cos(ai), math.cos(aj), math.cos(ak)
     cc, cs = ci * ck, ci * sk
     sc, ss = si * ck, si * sk
 
-    mat = np.empty(euler.shape[:-1] + (3, 3), dtype=np.float64)
-    mat[..., 2, 2] = cj * ck
-    mat[..., 2, 1] = sj * sc - cs
-    mat[..., 2, 0] = sj * cc + ss
-    mat[..., 1, 2] = cj * sk
-    mat[..., 1, 1] = sj * ss + cc
-    mat[..., 1, 0] = sj * cs - sc
-    mat[..., 0, 2] = -sj
-    mat[..., 0, 1] = cj * si
-    mat[..., 0, 0] = cj * ci
+    mat[2, 2] = cj * ck
+    mat[2, 1] = sj * sc - cs
+    mat[2, 0] = sj * cc + ss
+    mat[1, 2] = cj * sk
+    mat[1, 1] = sj * ss + cc
+    mat[1, 0] = sj * cs - sc
+    mat[0, 2] = -sj
+    mat[0, 1] = cj * si
+    mat[0, 0] = cj * ci
     return mat
 
 
-def euler2quat(euler):
-    """ Convert Euler Angles to Quaternions.  See rotation.py for notes """
-    euler = np.asarray(euler, dtype=np.float64)
-    assert euler.shape[-1] == 3, "Invalid shape euler {}".format(euler)
-
-    ai, aj, ak = euler[..., 2] / 2, -euler[..., 1] / 2, euler[..., 0] / 2
-    si, sj, sk = np.sin(ai), np.sin(aj), np.sin(ak)
-    ci, cj, ck = np.cos(ai), np.cos(aj), np.cos(ak)
+def _euler2quat_single(euler, quat):
+    ai, aj, ak = euler[2] / 2, -euler[1] / 2, euler[0] / 2
+    si, sj, sk = math.sin(ai), math.sin(aj), math.sin(ak)
+    ci, cj, ck = math.cos(ai), math.cos(aj), math.cos(ak)
     cc, cs = ci * ck, ci * sk
     sc, ss = si * ck, si * sk
 
-    quat = np.empty(euler.shape[:-1] + (4,), dtype=np.float64)
-    quat[..., 0] = cj * cc + sj * ss
-    quat[..., 3] = cj * sc - sj * cs
-    quat[..., 2] = -(cj * ss + sj * cc)
-    quat[..., 1] = cj * cs - sj * sc
+    quat[0] = cj * cc + sj * ss
+    quat[3] = cj * sc - sj * cs
+    quat[2] = -(cj * ss + sj * cc)
+    quat[1] = cj * cs - sj * sc
     return quat
 
 
-def mat2euler(mat):
-    """ Convert Rotation Matrix to Euler Angles.  See rotation.py for notes """
-    mat = np.asarray(mat, dtype=np.float64)
+def _mat2euler_single(mat, euler):
+    cy = math.sqrt(mat[2][2] * mat[2][2] + mat[1][2] * mat[1][2])
+    if cy > 4.0 * _eps(euler.dtype):
+        euler[2] = -math.atan2(mat[0][1], mat[0][0])
+        euler[0] = -math.atan2(mat[1][2], mat[2][2])
+    else:
+        euler[2] = -math.atan2(-mat[1][0], mat[1][1])
+        euler[0] = 0.0
+    euler[1] = -math.atan2(-mat[0][2], cy)
+    return euler
+
+
+def _quat2mat_single(quat, mat):
+    w, x, y, z = quat
+    Nq = w * w + x * x + y * y + z * z
+    if not Nq > _eps(mat.dtype):
+        mat[...] = _EYE3
+        return mat
+    s = 2.0 / Nq
+    X, Y, Z = x * s, y * s, z * s
+    wX, wY, wZ = w * X, w * Y, w * Z
+    xX, xY, xZ = x * X, x * Y, x * Z
+    yY, yZ, zZ = y * Y, y * Z, z * Z
+
+    mat[0, 0] = 1.0 - (yY + zZ)
+    mat[0, 1] = xY - wZ
+    mat[0, 2] = xZ + wY
+    mat[1, 0] = xY + wZ
+    mat[1, 1] = 1.0 - (xX + zZ)
+    mat[1, 2] = yZ - wX
+    mat[2, 0] = xZ - wY
+    mat[2, 1] = yZ + wX
+    mat[2, 2] = 1.0 - (xX + yY)
+    return mat
+
+
+def euler2mat(euler, out=None, dtype=np.float64):
+    """ Convert Euler Angles to Rotation Matrix.  See rotation.py for notes
+    Results are written into out (..., 3, 3) if provided. Use dtype=None to preserve float32 inputs.
+    """
+    euler = _as_float_array(euler, dtype, out)
+    assert euler.shape[-1] == 3, "Invalid shaped euler {}".format(euler)
+    mat = _output(out, euler.shape[:-1] + (3, 3), euler.dtype)
+    if euler.ndim == 1:
+        return _euler2mat_single(euler.tolist(), mat)
+    if _use_backend(mat):
+        _backend.euler2mat(euler.reshape(-1, 3), mat.reshape(-1, 3, 3))
+        return mat
+    si, sj, sk, ci, cj, ck, cc, cs, sc, ss = _workspace("euler2mat", euler.shape[:-1], euler.dtype, 10)
+
+    # ai, aj, ak = -euler[..., 2], -euler[..., 1], -euler[..., 0]
+    np.multiply(euler[..., 2], -1.0, out=si)
+    np.multiply(euler[..., 1], -1.0, out=sj)
+    np.multiply(euler[..., 0], -1.0, out=sk)
+    np.cos(si, out=ci)
+    np.cos(sj, out=cj)
+    np.cos(sk, out=ck)
+    np.sin(si, out=si)
+    np.sin(sj, out=sj)
+    np.sin(sk, out=sk)
+    np.multiply(ci, ck, out=cc)
+    np.multiply(ci, sk, out=cs)
+    np.multiply(si, ck, out=sc)
+    np.multiply(si, sk, out=ss)
+
+    np.multiply(cj, ck, out=mat[..., 2, 2])
+    m = mat[..., 2, 1]
+    np.multiply(sj, sc, out=m)
+    np.subtract(m, cs, out=m)
+    m = mat[..., 2, 0]
+    np.multiply(sj, cc, out=m)
+    np.add(m, ss, out=m)
+    np.multiply(cj, sk, out=mat[..., 1, 2])
+    m = mat[..., 1, 1]
+    np.multiply(sj, ss, out=m)
+    np.add(m, cc, out=m)
+    m = mat[..., 1, 0]
+    np.multiply(sj, cs, out=m)
+    np.subtract(m, sc, out=m)
+    np.multiply(sj, -1.0, out=mat[..., 0, 2])
+    np.multiply(cj, si, out=mat[..., 0, 1])
+    np.multiply(cj, ci, out=mat[..., 0, 0])
+    return mat
+
+
+def euler2quat(euler, out=None, dtype=np.float64):
+    """ Convert Euler Angles to Quaternions.  See rotation.py for notes
+    Results are written into out (..., 4) if provided. Use dtype=None to preserve float32 inputs.
+    """
+    euler = _as_float_array(euler, dtype, out)
+    assert euler.shape[-1] == 3, "Invalid shape euler {}".format(euler)
+    quat = _output(out, euler.shape[:-1] + (4,), euler.dtype)
+    if euler.ndim == 1:
+        return _euler2quat_single(euler.tolist(), quat)
+    if _use_backend(quat):
+        _backend.euler2quat(euler.reshape(-1, 3), quat.reshape(-1, 4))
+        return quat
+    si, sj, sk, ci, cj, ck, cc, cs, sc, ss, t = _workspace("euler2quat", euler.shape[:-1], euler.dtype, 11)
+
+    # ai, aj, ak = euler[..., 2] / 2, -euler[..., 1] / 2, euler[..., 0] / 2
+    np.multiply(euler[..., 2], 0.5, out=si)
+    np.multiply(euler[..., 1], -0.5, out=sj)
+    np.multiply(euler[..., 0], 0.5, out=sk)
+    np.cos(si, out=ci)
+    np.cos(sj, out=cj)
+    np.cos(sk, out=ck)
+    np.sin(si, out=si)
+    np.sin(sj, out=sj)
+    np.sin(sk, out=sk)
+    np.multiply(ci, ck, out=cc)
+    np.multiply(ci, sk, out=cs)
+    np.multiply(si, ck, out=sc)
+    np.multiply(si, sk, out=ss)
+
+    q = quat[..., 0]
+    np.multiply(cj, cc, out=q)
+    np.multiply(sj, ss, out=t)
+    np.add(q, t, out=q)
+    q = quat[..., 3]
+    np.multiply(cj, sc, out=q)
+    np.multiply(sj, cs, out=t)
+    np.subtract(q, t, out=q)
+    q = quat[..., 2]
+    np.multiply(cj, ss, out=q)
+    np.multiply(sj, cc, out=t)
+    np.add(q, t, out=q)
+    np.multiply(q, -1.0, out=q)
+    q = quat[..., 1]
+    np.multiply(cj, cs, out=q)
+    np.multiply(sj, sc, out=t)
+    np.subtract(q, t, out=q)
+    return quat
+
+
+def mat2euler(mat, out=None, dtype=np.float64):
+    """ Convert Rotation Matrix to Euler Angles.  See rotation.py for notes
+    Results are written into out (..., 3) if provided. Use dtype=None to preserve float32 inputs.
+    """
+    mat = _as_float_array(mat, dtype, out)
     assert mat.shape[-2:] == (3, 3), "Invalid shape matrix {}".format(mat)
+    euler = _output(out, mat.shape[:-1], mat.dtype)
+    if mat.ndim == 2:
+        return _mat2euler_single(mat.tolist(), euler)
+    if _use_backend(euler):
+        _backend.mat2euler(mat.reshape(-1, 3, 3), euler.reshape(-1, 3), 4.0 * _eps(mat.dtype))
+        return euler
+    cy, t = _workspace("mat2euler", mat.shape[:-2], mat.dtype, 2)
+    condition, not_condition = _workspace("mat2euler", mat.shape[:-2], np.bool_, 2)
+
+    np.multiply(mat[..., 2, 2], mat[..., 2, 2], out=cy)
+    np.multiply(mat[..., 1, 2], mat[..., 1, 2], out=t)
+    np.add(cy, t, out=cy)
+    np.sqrt(cy, out=cy)
+    np.greater(cy, 4.0 * _eps(mat.dtype), out=condition)
+    np.logical_not(condition, out=not_condition)
+    gimbal_lock = not_condition.any()
 
-    cy = np.sqrt(mat[..., 2, 2] * mat[..., 2, 2] + mat[..., 1, 2] * mat[..., 1, 2])
-    condition = cy > _EPS4
-    euler = np.empty(mat.shape[:-1], dtype=np.float64)
-    euler[..., 2] = np.where(condition,
-                             -np.arctan2(mat[..., 0, 1], mat[..., 0, 0]),
-                             -np.arctan2(-mat[..., 1, 0], mat[..., 1, 1]))
-    euler[..., 1] = np.where(condition,
-                             -np.arctan2(-mat[..., 0, 2], cy),
-                             -np.arctan2(-mat[..., 0, 2], cy))
-    euler[..., 0] = np.where(condition,
-                             -np.arctan2(mat[..., 1, 2], mat[..., 2, 2]),
-                             0.0)
+    e = euler[..., 2]
+    np.arctan2(mat[..., 0, 1], mat[..., 0, 0], out=e)
+    if gimbal_lock:
+        np.multiply(mat[..., 1, 0], -1.0, out=t)
+        np.arctan2(t, mat[..., 1, 1], out=t)
+        np.copyto(e, t, where=not_condition)
+    np.multiply(e, -1.0, out=e)
+    e = euler[..., 1]
+    np.multiply(mat[..., 0, 2], -1.0, out=e)
+    np.arctan2(e, cy, out=e)
+    np.multiply(e, -1.0, out=e)
+    e = euler[..., 0]
+    np.arctan2(mat[..., 1, 2], mat[..., 2, 2], out=e)
+    np.multiply(e, -1.0, out=e)
+    if gimbal_lock:
+        np.copyto(e, 0.0, where=not_condition)
     return euler
 
 
-def mat2quat(mat):
-    """ Convert Rotation Matrix to Quaternion.  See rotation.py for notes """
+def mat2quat(mat, robust=False):
+    """ Convert Rotation Matrix to Quaternion.  See rotation.py for notes
+    Uses a closed form (Shepperd) selection by default. Pass robust=True to
+    use the eigen-decomposition path, better suited for nearly non-orthogonal inputs.
+    """
     mat = np.asarray(mat, dtype=np.float64)
     assert mat.shape[-2:] == (3, 3), "Invalid shape matrix {}".format(mat)
+    if robust:
+        return _mat2quat_eigh(mat)
+    if _backend is not None:
+        q = np.empty(mat.shape[:-2] + (4,), dtype=np.float64)
+        _backend.mat2quat(mat.reshape(-1, 3, 3), q.reshape(-1, 4))
+        return q
 
+    Qxx, Qyx, Qzx = mat[..., 0, 0], mat[..., 0, 1], mat[..., 0, 2]
+    Qxy, Qyy, Qzy = mat[..., 1, 0], mat[..., 1, 1], mat[..., 1, 2]
+    Qxz, Qyz, Qzz = mat[..., 2, 0], mat[..., 2, 1], mat[..., 2, 2]
+    # Symmetric matrix 4*q*q^T, each row is a scaled (by 4*q_i) copy of q
+    K = np.empty(mat.shape[:-2] + (4, 4), dtype=np.float64)
+    K[..., 0, 0] = 1.0 + Qxx + Qyy + Qzz
+    K[..., 1, 1] = 1.0 + Qxx - Qyy - Qzz
+    K[..., 2, 2] = 1.0 - Qxx + Qyy - Qzz
+    K[..., 3, 3] = 1.0 - Qxx - Qyy + Qzz
+    K[..., 0, 1] = K[..., 1, 0] = Qyz - Qzy
+    K[..., 0, 2] = K[..., 2, 0] = Qzx - Qxz
+    K[..., 0, 3] = K[..., 3, 0] = Qxy - Qyx
+    K[..., 1, 2] = K[..., 2, 1] = Qyx + Qxy
+    K[..., 1, 3] = K[..., 3, 1] = Qzx + Qxz
+    K[..., 2, 3] = K[..., 3, 2] = Qzy + Qyz
+    # Select the row with the largest diagonal (largest |q_i|) for numerical stability
+    idx = np.argmax(np.diagonal(K, axis1=-2, axis2=-1), axis=-1)
+    q = np.take_along_axis(K, idx[..., np.newaxis, np.newaxis], axis=-2)[..., 0, :]
+    q /= np.linalg.norm(q, axis=-1, keepdims=True)
+    # Prefer quaternion with positive w
+    # (q * -1 corresponds to same rotation as q)
+    q *= np.where(q[..., 0:1] < 0, -1.0, 1.0)
+    return q
+
+
+def _mat2quat_eigh(mat):
+    """ Eigen-decomposition based mat2quat (Bar-Itzhack). Robust to non-orthogonal inputs """
     Qxx, Qyx, Qzx = mat[..., 0, 0], mat[..., 0, 1], mat[..., 0, 2]
     Qxy, Qyy, Qzy = mat[..., 1, 0], mat[..., 1, 1], mat[..., 1, 2]
     Qxz, Qyz, Qzz = mat[..., 2, 0], mat[..., 2, 1], mat[..., 2, 2]
@@ -117,48 +474,237 @@ def mat2quat(mat):
     K[..., 3, 2] = Qxy - Qyx
     K[..., 3, 3] = Qxx + Qyy + Qzz
     K /= 3.0
-    # TODO: vectorize this -- probably could be made faster
-    q = np.empty(K.shape[:-2] + (4,))
-    it = np.nditer(q[..., 0], flags=['multi_index'])
-    while not it.finished:
-        # Use Hermitian eigenvectors, values for speed
-        vals, vecs = np.linalg.eigh(K[it.multi_index])
-        # Select largest eigenvector, reorder to w,x,y,z quaternion
-        q[it.multi_index] = vecs[[3, 0, 1, 2], np.argmax(vals)]
-        # Prefer quaternion with positive w
-        # (q * -1 corresponds to same rotation as q)
-        if q[it.multi_index][0] < 0:
-            q[it.multi_index] *= -1
-        it.iternext()
+    # Use Hermitian eigenvectors, values for speed (batched over leading dims)
+    vals, vecs = np.linalg.eigh(K)
+    # Select largest eigenvector, reorder to w,x,y,z quaternion
+    idx = np.argmax(vals, axis=-1)
+    vec = np.take_along_axis(vecs, idx[..., np.newaxis, np.newaxis], axis=-1)[..., 0]
+    q = vec[..., [3, 0, 1, 2]]
+    # Prefer quaternion with positive w
+    q *= np.where(q[..., 0:1] < 0, -1.0, 1.0)
     return q
 
 
-def quat2euler(quat):
-    """ Convert Quaternion to Euler Angles.  See rotation.py for notes """
-    return mat2euler(quat2mat(quat))
-
-
-def quat2mat(quat):
-    """ Convert Quaternion to Euler Angles.  See rotation.py for notes """
-    quat = np.asarray(quat, dtype=np.float64)
+def quat2euler(quat, out=None, dtype=np.float64):
+    """ Convert Quaternion to Euler Angles.  See rotation.py for notes
+    Fused mat2euler(quat2mat(quat)): only the five (seven under gimbal lock) matrix
+    entries needed for the angles are formed.
+    """
+    quat = _as_float_array(quat, dtype, out)
     assert quat.shape[-1] == 4, "Invalid shape quat {}".format(quat)
+    euler = _output(out, quat.shape[:-1] + (3,), quat.dtype)
+    if quat.ndim == 1:
+        return _quat2euler_single(quat.tolist(), euler)
+    if _use_backend(euler):
+        _backend.quat2euler(quat.reshape(-1, 4), euler.reshape(-1, 3), _eps(quat.dtype))
+        return euler
+    eps = _eps(quat.dtype)
 
     w, x, y, z = quat[..., 0], quat[..., 1], quat[..., 2], quat[..., 3]
-    Nq = np.sum(quat * quat, axis=-1)
+    Nq = w * w + x * x + y * y + z * z
     s = 2.0 / Nq
     X, Y, Z = x * s, y * s, z * s
-    wX, wY, wZ = w * X, w * Y, w * Z
-    xX, xY, xZ = x * X, x * Y, x * Z
-    yY, yZ, zZ = y * Y, y * Z, z * Z
+    m00 = 1.0 - (y * Y + z * Z)
+    m01 = x * Y - w * Z
+    m02 = x * Z + w * Y
+    m12 = y * Z - w * X
+    m22 = 1.0 - (x * X + y * Y)
+
+    cy = np.sqrt(m22 * m22 + m12 * m12)
+    np.arctan2(m01, m00, out=euler[..., 2])
+    np.arctan2(-m02, cy, out=euler[..., 1])
+    np.arctan2(m12, m22, out=euler[..., 0])
+    np.multiply(euler, -1.0, out=euler)
+
+    # Gimbal lock: only evaluate the alternate branch where it is needed
+    lock = ~(cy > 4.0 * eps)
+    if lock.any():
+        xl, zl, wl = x[lock], z[lock], w[lock]
+        Xl, Yl, Zl = X[lock], Y[lock], Z[lock]
+        euler[..., 2][lock] = -np.arctan2(-(xl * Yl + wl * Zl), 1.0 - (xl * Xl + zl * Zl))
+        euler[..., 0][lock] = 0.0
+
+    # Near zero norm quaternions map to identity
+    invalid = ~(Nq > eps)
+    if invalid.any():
+        euler[invalid] = 0.0
+    return euler
+
+
+def _quat2euler_single(quat, euler):
+    w, x, y, z = quat
+    Nq = w * w + x * x + y * y + z * z
+    if not Nq > _eps(euler.dtype):
+        euler[...] = 0.0
+        return euler
+    s = 2.0 / Nq
+    X, Y, Z = x * s, y * s, z * s
+    m02 = x * Z + w * Y
+    m12 = y * Z - w * X
+    m22 = 1.0 - (x * X + y * Y)
+
+    cy = math.sqrt(m22 * m22 + m12 * m12)
+    if cy > 4.0 * _eps(euler.dtype):
+        euler[2] = -math.atan2(x * Y - w * Z, 1.0 - (y * Y + z * Z))
+        euler[0] = -math.atan2(m12, m22)
+    else:
+        euler[2] = -math.atan2(-(x * Y + w * Z), 1.0 - (x * X + z * Z))
+        euler[0] = 0.0
+    euler[1] = -math.atan2(-m02, cy)
+    return euler
+
+
+def quat2mat(quat, out=None, dtype=np.float64):
+    """ Convert Quaternion to Rotation Matrix.  See rotation.py for notes
+    Results are written into out (..., 3, 3) if provided. Use dtype=None to preserve float32 inputs.
+    """
+    quat = _as_float_array(quat, dtype, out)
+    assert quat.shape[-1] == 4, "Invalid shape quat {}".format(quat)
+    mat = _output(out, quat.shape[:-1] + (3, 3), quat.dtype)
+    if quat.ndim == 1:
+        return _quat2mat_single(quat.tolist(), mat)
+    if _use_backend(mat):
+        _backend.quat2mat(quat.reshape(-1, 4), mat.reshape(-1, 3, 3), _eps(quat.dtype))
+        return mat
+    Nq, s, X, Y, Z, wX, wY, wZ, xX, xY, xZ, yY, yZ, zZ = _workspace("quat2mat", quat.shape[:-1], quat.dtype, 14)
+    invalid, = _workspace("quat2mat", quat.shape[:-1], np.bool_, 1)
+
+    w, x, y, z = quat[..., 0], quat[..., 1], quat[..., 2], quat[..., 3]
+    np.multiply(w, w, out=Nq)
+    np.multiply(x, x, out=s)
+    np.add(Nq, s, out=Nq)
+    np.multiply(y, y, out=s)
+    np.add(Nq, s, out=Nq)
+    np.multiply(z, z, out=s)
+    np.add(Nq, s, out=Nq)
+    np.divide(2.0, Nq, out=s)
+    np.multiply(x, s, out=X)
+    np.multiply(y, s, out=Y)
+    np.multiply(z, s, out=Z)
+    np.multiply(w, X, out=wX)
+    np.multiply(w, Y, out=wY)
+    np.multiply(w, Z, out=wZ)
+    np.multiply(x, X, out=xX)
+    np.multiply(x, Y, out=xY)
+    np.multiply(x, Z, out=xZ)
+    np.multiply(y, Y, out=yY)
+    np.multiply(y, Z, out=yZ)
+    np.multiply(z, Z, out=zZ)
+
+    m = mat[..., 0, 0]
+    np.add(yY, zZ, out=m)
+    np.subtract(1.0, m, out=m)
+    np.subtract(xY, wZ, out=mat[..., 0, 1])
+    np.add(xZ, wY, out=mat[..., 0, 2])
+    np.add(xY, wZ, out=mat[..., 1, 0])
+    m = mat[..., 1, 1]
+    np.add(xX, zZ, out=m)
+    np.subtract(1.0, m, out=m)
+    np.subtract(yZ, wX, out=mat[..., 1, 2])
+    np.subtract(xZ, wY, out=mat[..., 2, 0])
+    np.add(yZ, wX, out=mat[..., 2, 1])
+    m = mat[..., 2, 2]
+    np.add(xX, yY, out=m)
+    np.subtract(1.0, m, out=m)
+
+    # Near zero norm quaternions map to identity
+    np.greater(Nq, _eps(quat.dtype), out=invalid)
+    np.logical_not(invalid, out=invalid)
+    if invalid.any():
+        np.copyto(mat, _EYE3, where=invalid[..., np.newaxis, np.newaxis])
+    return mat
+
+
+# Points rotated per block by quat_rotate, bounds its temporaries for large point clouds
+_ROTATE_BLOCK = 65536
+
+
+def quat_rotate(quat, vec, out=None, dtype=np.float64):
+    """ Rotate vectors by Quaternions, without forming rotation matrices.
+    quat (..., 4) broadcasts against vec (..., 3), or against point clouds vec (..., M, 3)
+    when vec has one more dim than quat. Non unit quaternions are normalized (as in quat2mat).
+    Results are written into out if provided (out=vec rotates in place). Use dtype=None to preserve float32 inputs.
+    """
+    vec = _as_float_array(vec, dtype, out)
+    quat = np.asarray(quat, dtype=vec.dtype)
+    assert quat.shape[-1] == 4, "Invalid shape quat {}".format(quat)
+    assert vec.shape[-1] == 3, "Invalid shape vec {}".format(vec)
+    if quat.ndim == 1 and vec.ndim == 1:
+        return _quat_rotate_single(quat.tolist(), vec.tolist(), _output(out, (3,), vec.dtype))
+    cloud = vec.ndim > quat.ndim
+    if cloud:
+        quat = quat[..., np.newaxis, :]
+    out = _output(out, np.broadcast_shapes(quat.shape[:-1], vec.shape[:-1]) + (3,), vec.dtype)
+
+    # v' = v + w*t + u x t, with t = 2 u x v / |q|^2. Near zero norm quaternions leave v unchanged
+    Nq = np.sum(quat * quat, axis=-1, keepdims=True)
+    valid = Nq > _eps(vec.dtype)
+    s = np.where(valid, 2.0 / np.where(valid, Nq, 1.0), 0.0).astype(vec.dtype)
+    w, u = quat[..., 0:1], quat[..., 1:]
+    su = u * s
+
+    if cloud and vec.shape[-2] > _ROTATE_BLOCK:
+        for i in range(0, vec.shape[-2], _ROTATE_BLOCK):
+            block = slice(i, i + _ROTATE_BLOCK)
+            _quat_rotate(w, u, su, vec[..., block, :], out[..., block, :])
+    else:
+        _quat_rotate(w, u, su, vec, out)
+    return out
+
+
+def _quat_rotate(w, u, su, vec, out):
+    w = w[..., 0]
+    ux, uy, uz = u[..., 0], u[..., 1], u[..., 2]
+    sx, sy, sz = su[..., 0], su[..., 1], su[..., 2]
+    vx, vy, vz = vec[..., 0], vec[..., 1], vec[..., 2]
+    tx = sy * vz - sz * vy
+    ty = sz * vx - sx * vz
+    tz = sx * vy - sy * vx
+    # out may alias vec: each vec component is read only by its own output component
+    out[..., 0] = vx + w * tx + (uy * tz - uz * ty)
+    out[..., 1] = vy + w * ty + (uz * tx - ux * tz)
+    out[..., 2] = vz + w * tz + (ux * ty - uy * tx)
+
+
+def _quat_rotate_single(quat, vec, out):
+    w, ux, uy, uz = quat
+    vx, vy, vz = vec
+    Nq = w * w + ux * ux + uy * uy + uz * uz
+    s = 2.0 / Nq if Nq > _eps(out.dtype) else 0.0
+    tx = s * (uy * vz - uz * vy)
+    ty = s * (uz * vx - ux * vz)
+    tz = s * (ux * vy - uy * vx)
+    out[0] = vx + w * tx + (uy * tz - uz * ty)
+    out[1] = vy + w * ty + (uz * tx - ux * tz)
+    out[2] = vz + w * tz + (ux * ty - uy * tx)
+    return out
+
+if __name__ == '__main__':
+    import timeit
+    import tracemalloc
+
+    # Per call latency (and steady state allocations) of single element conversions
+    n_calls = 20000
+    for dtype in (np.float64, np.float32):
+        euler = np.array([0.1, -0.2, 0.3], dtype=dtype)
+        quat = euler2quat(euler, dtype=dtype)
+        mat = euler2mat(euler, dtype=dtype)
+        cases = (
+            ("euler2mat", euler2mat, euler, np.empty((3, 3), dtype=dtype)),
+            ("euler2quat", euler2quat, euler, np.empty(4, dtype=dtype)),
+            ("quat2mat", quat2mat, quat, np.empty((3, 3), dtype=dtype)),
+            ("mat2euler", mat2euler, mat, np.empty(3, dtype=dtype)),
+        )
+        print(f"dtype: {np.dtype(dtype).name}")
+        for name, fn, arg, out in cases:
+            t_alloc = timeit.timeit(lambda: fn(arg, dtype=None), number=n_calls) / n_calls
+            t_out = timeit.timeit(lambda: fn(arg, out=out), number=n_calls) / n_calls
 
-    mat = np.empty(quat.shape[:-1] + (3, 3), dtype=np.float64)
-    mat[..., 0, 0] = 1.0 - (yY + zZ)
-    mat[..., 0, 1] = xY - wZ
-    mat[..., 0, 2] = xZ + wY
-    mat[..., 1, 0] = xY + wZ
-    mat[..., 1, 1] = 1.0 - (xX + zZ)
-    mat[..., 1, 2] = yZ - wX
-    mat[..., 2, 0] = xZ - wY
-    mat[..., 2, 1] = yZ + wX
-    mat[..., 2, 2] = 1.0 - (xX + yY)
-    return np.where((Nq > _FLOAT_EPS)[..., np.newaxis, np.newaxis], mat, np.eye(3))
+            tracemalloc.start()
+            fn(arg, out=out)
+            before = tracemalloc.get_traced_memory()[0]
+            for _ in range(1000):
+                fn(arg, out=out)
+            retained = tracemalloc.get_traced_memory()[0] - before
+            tracemalloc.stop()
+            print(f"\t{name:<12} alloc: {t_alloc*1e6:6.2f} us/call\tout=: {t_out*1e6:6.2f} us/call\tretained: {retained} bytes")
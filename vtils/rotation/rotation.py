@@ -0,0 +1,153 @@
+import numpy as np
+
+from vtils.rotation.quatmath import euler2mat, euler2quat, mat2euler, mat2quat, mulQuat, negQuat, quat2euler, quat2mat
+
+# Trailing shape of each representation
+_SHAPES = {"quat": (4,), "mat": (3, 3), "euler": (3,)}
+
+# Conversion between representations (source, target)
+_CONVERT = {
+    ("quat", "mat"): quat2mat,
+    ("quat", "euler"): quat2euler,
+    ("mat", "quat"): mat2quat,
+    ("mat", "euler"): mat2euler,
+    ("euler", "quat"): euler2quat,
+    ("euler", "mat"): euler2mat,
+}
+
+
+class Rotation():
+    """
+    Orientation stored in one canonical representation (the one it was set with).
+    quat, mat and euler are converted lazily on first access and memoized until
+    the rotation is set again. Returned arrays are read-only, so that cached
+    values can't go out of sync; use the setters to mutate.
+    """
+    __slots__ = ("_source", "_quat", "_mat", "_euler")
+
+    def __init__(self, quat=None, mat=None, euler=None):
+        """
+        Args:
+            quat: (w, x, y, z) quaternion
+            mat: 3x3 rotation matrix
+            euler: euler angles. See quatmath.py for conventions
+        Exactly one of quat, mat, euler should be provided.
+        """
+        given = [(rep, val) for rep, val in (("quat", quat), ("mat", mat), ("euler", euler)) if val is not None]
+        assert len(given) == 1, "Provide exactly one of quat, mat, euler"
+        self._set(*given[0])
+
+    @classmethod
+    def from_quat(cls, quat):
+        return cls(quat=quat)
+
+    @classmethod
+    def from_mat(cls, mat):
+        return cls(mat=mat)
+
+    @classmethod
+    def from_euler(cls, euler):
+        return cls(euler=euler)
+
+    @classmethod
+    def identity(cls, shape=()):
+        quat = np.zeros(shape + (4,))
+        quat[..., 0] = 1.0
+        return cls(quat=quat)
+
+    def _check_shape(self, shape):
+        assert shape == (), "Rotation holds a single orientation, use RotationArray for batches. Got batch shape {}".format(shape)
+
+    def _set(self, rep, val):
+        # Own a private copy so external edits don't leak into the caches
+        val = np.array(val, dtype=np.float64)
+        n_dims = len(_SHAPES[rep])
+        assert val.shape[val.ndim - n_dims:] == _SHAPES[rep], "Invalid shape {} {}".format(rep, val.shape)
+        self._check_shape(val.shape[:val.ndim - n_dims])
+        val.setflags(write=False)
+        self._quat = self._mat = self._euler = None
+        setattr(self, "_" + rep, val)
+        self._source = rep
+
+    def _get(self, rep):
+        val = getattr(self, "_" + rep)
+        if val is None:
+            val = _CONVERT[(self._source, rep)](getattr(self, "_" + self._source))
+            val.setflags(write=False)
+            setattr(self, "_" + rep, val)
+        return val
+
+    @property
+    def quat(self):
+        return self._get("quat")
+
+    @quat.setter
+    def quat(self, quat):
+        self._set("quat", quat)
+
+    @property
+    def mat(self):
+        return self._get("mat")
+
+    @mat.setter
+    def mat(self, mat):
+        self._set("mat", mat)
+
+    @property
+    def euler(self):
+        return self._get("euler")
+
+    @euler.setter
+    def euler(self, euler):
+        self._set("euler", euler)
+
+    @property
+    def shape(self):
+        """ Batch shape """
+        val = getattr(self, "_" + self._source)
+        return val.shape[:val.ndim - len(_SHAPES[self._source])]
+
+    def inv(self):
+        """ Inverse rotation (assumes unit quaternion) """
+        return type(self)(quat=negQuat(self.quat))
+
+    def __mul__(self, other):
+        """ Composition: (self * other) applies other first, then self """
+        quat = mulQuat(self.quat, other.quat)
+        cls = RotationArray if quat.ndim > 1 else Rotation
+        return cls(quat=quat)
+
+    def __repr__(self):
+        return "{}({}={})".format(type(self).__name__, self._source, getattr(self, "_" + self._source).tolist())
+
+
+class RotationArray(Rotation):
+    """
+    Batch of orientations with leading batch dims (...). See Rotation
+    """
+    __slots__ = ()
+
+    def _check_shape(self, shape):
+        pass
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        rep = self._source
+        val = getattr(self, "_" + rep)[index]
+        cls = Rotation if val.ndim == len(_SHAPES[rep]) else RotationArray
+        return cls(**{rep: val})
+
+
+if __name__ == '__main__':
+    import timeit
+
+    rot = Rotation(euler=[0.1, 0.2, 0.3])
+    print(rot, "\n", rot.quat, "\n", rot.mat)
+    t_first = timeit.timeit(lambda: Rotation(euler=[0.1, 0.2, 0.3]).mat, number=1000) / 1000
+    t_cached = timeit.timeit(lambda: rot.mat, number=100000) / 100000
+    print(f"First .mat access: {t_first*1e6:.2f} us, cached: {t_cached*1e6:.3f} us")
+
+    rots = RotationArray(quat=np.random.normal(size=(1000, 4)))
+    print(rots.shape, rots[0], (rots * rots.inv())[:2].euler)
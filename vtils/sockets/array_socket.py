@@ -0,0 +1,229 @@
+import os
+import socket
+import time
+
+import numpy as np
+
+from vtils.sockets.array_stream import _HEADER, FLAG_FRAGMENT, MAX_NDIM, header_nbytes, pack_header, unpack_header
+
+HELP = """
+------------------------------------------------------------------------
+Stream numpy arrays over TCP or unix domain sockets: reliable, in order,
+any size. Messages use the array_stream.py header (dtype, shape, sequence
+number, send time, stream id, nbytes), which also frames them on the byte
+stream, followed by the array bytes. Same API as ArraySender/ArrayReceiver,
+so a link can switch between UDP, TCP and unix sockets.
+Address: (host, port) for TCP, a file path for a unix domain socket.
+Sender (connects, header and array gathered by sendmsg, no copy):
+    - sender = ArraySocketSender(("192.168.0.2", 5006), nodelay=True)
+    - sender.send(arr)
+Receiver (listens, accepts one sender at a time, reconnects):
+    - receiver = ArraySocketReceiver("/tmp/robot.sock", max_nbytes=largest array)
+    - arr = receiver.recv(timeout=1.0)   # view, valid until the next recv
+    - receiver.recv(out=buffer)          # array is received straight into buffer
+    - receiver.seq, receiver.latency, receiver.received, receiver.invalid
+------------------------------------------------------------------------
+"""
+
+
+def _stream_socket(address):
+    family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+    return socket.socket(family, socket.SOCK_STREAM)
+
+
+def _sendmsg_all(sock, buffers):
+    """ sendmsg until every buffer is sent (stream sockets may send part of them) """
+    buffers = [memoryview(buf) for buf in buffers]
+    while buffers:
+        sent = sock.sendmsg(buffers)
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers[0])
+            buffers.pop(0)
+        if buffers:
+            buffers[0] = buffers[0][sent:]
+
+
+class ArraySocketSender:
+    def __init__(self, address=("127.0.0.1", 5006), stream: int = 0, nodelay: bool = True, sndbuf: int = None):
+        """
+        nodelay: TCP_NODELAY, send every array right away instead of coalescing small ones (Nagle)
+        sndbuf:  socket send buffer (SO_SNDBUF) bytes
+        """
+        self.address = address
+        self.stream = stream
+        self.seq = 0
+        self.sock = _stream_socket(address)
+        if sndbuf:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+        if nodelay and self.sock.family == socket.AF_INET:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.connect(address)
+
+    def send(self, arr):
+        """ Send arr (header and data are gathered by the kernel, no copy). Returns its sequence number """
+        arr = np.ascontiguousarray(arr)
+        self.seq += 1
+        _sendmsg_all(self.sock, [pack_header(arr, self.seq, self.stream), memoryview(arr).cast("B")])
+        return self.seq
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ArraySocketReceiver:
+    def __init__(self, address=("0.0.0.0", 5006), max_nbytes: int = 1 << 20, rcvbuf: int = None):
+        """
+        max_nbytes: largest array received as a view (the receive buffer is preallocated), larger ones are skipped
+        rcvbuf:     socket receive buffer (SO_RCVBUF) bytes
+        """
+        self.listener = _stream_socket(address)
+        if self.listener.family == socket.AF_UNIX:
+            if os.path.exists(address):
+                os.unlink(address)  # left by a receiver that didn't close
+        else:
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if rcvbuf:
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)  # inherited by accepted connections
+        self.listener.bind(address)
+        self.listener.listen(1)
+        self.address = self.listener.getsockname()
+        self.conn = None
+        self._buffer = bytearray(max_nbytes)  # preallocated, recv() returns views of it
+        self._header_buffer = bytearray(header_nbytes(MAX_NDIM))
+        self.max_nbytes = max_nbytes
+
+        # Stats of the last (valid) message, and totals
+        self.header = None
+        self.seq = 0
+        self.latency = np.nan  # seconds, sender and receiver clocks must agree
+        self.received = 0
+        self.lost = 0  # sequence gaps (senders restart at 1 on reconnection)
+        self.invalid = 0  # not vtils messages, not matching out, or too large
+        self.connections = 0
+
+    def _accept(self, timeout):
+        self.listener.settimeout(timeout)
+        self.conn, _ = self.listener.accept()
+        self.connections += 1
+        self.seq = 0
+
+    def _disconnect(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def _recv_exact(self, view):
+        """ Fill view from the connection. Raises ConnectionError if the sender is gone """
+        while len(view):
+            n_bytes = self.conn.recv_into(view)
+            if not n_bytes:
+                raise ConnectionResetError("Vtils:> Sender disconnected")
+            view = view[n_bytes:]
+
+    def _skip(self, nbytes):
+        view = memoryview(self._buffer)
+        while nbytes:
+            chunk = min(nbytes, len(view))
+            self._recv_exact(view[:chunk])
+            nbytes -= chunk
+
+    def _track(self, header):
+        if header["seq"] > self.seq + 1 and self.seq:
+            self.lost += header["seq"] - self.seq - 1
+        self.seq = header["seq"]
+        self.header = header
+        self.latency = time.time() - header["stamp"]
+        self.received += 1
+
+    def recv(self, out=None, timeout: float = None):
+        """
+        Receive the next array. Returns None on timeout (seconds, None: block), which applies
+        to waiting for a sender and for the start of a message; a message is then read whole.
+            - out=None: returns a view into the receive buffer, valid until the next recv()
+            - out=array: shape and dtype must match, the array is received straight into out
+        Invalid messages are counted and skipped. A sender that disconnects, or whose stream
+        can't be parsed, is dropped and the next one accepted.
+        """
+        t_end = None if timeout is None else time.monotonic() + timeout
+        header_view = memoryview(self._header_buffer)
+        while True:
+            remaining = None if t_end is None else max(0.0, t_end - time.monotonic())
+            try:
+                if self.conn is None:
+                    self._accept(remaining)
+                self.conn.settimeout(remaining)
+                n_bytes = self.conn.recv_into(header_view[:_HEADER.size])
+                if not n_bytes:
+                    raise ConnectionResetError("Vtils:> Sender disconnected")
+                self.conn.settimeout(None)  # message started: read it whole, or lose the framing
+                self._recv_exact(header_view[n_bytes:_HEADER.size])
+                ndim, flags = self._header_buffer[8], self._header_buffer[9]
+                if ndim > MAX_NDIM or flags & FLAG_FRAGMENT:
+                    raise ValueError("Vtils:> Not a vtils array message")
+                self._recv_exact(header_view[_HEADER.size:header_nbytes(ndim)])
+                header = unpack_header(header_view[:header_nbytes(ndim)])
+
+                if out is not None and header["shape"] == out.shape and header["dtype"] == out.dtype:
+                    self._recv_exact(memoryview(out).cast("B"))
+                    self._track(header)
+                    return out
+                if out is not None or header["nbytes"] > self.max_nbytes:
+                    self._skip(header["nbytes"])
+                    self.invalid += 1  # out got somebody else's data, or too large
+                    continue
+                self._recv_exact(memoryview(self._buffer)[:header["nbytes"]])
+                self._track(header)
+                return np.frombuffer(self._buffer, dtype=header["dtype"], count=int(np.prod(header["shape"]))).reshape(header["shape"])
+            except (socket.timeout, BlockingIOError):  # BlockingIOError: timeout=0
+                if t_end is not None and time.monotonic() >= t_end:
+                    return None
+            except ValueError:
+                self.invalid += 1
+                self._disconnect()  # the byte stream can't be framed anymore
+            except ConnectionError:
+                self._disconnect()
+
+    def close(self):
+        self._disconnect()
+        self.listener.close()
+        if self.listener.family == socket.AF_UNIX:
+            try:
+                os.unlink(self.address)
+            except FileNotFoundError:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == '__main__':
+    import tempfile
+    import threading
+    from vtils.ipc import benchmark
+    print(HELP)
+
+    # Loopback check over both families: mixed arrays, as views and into preallocated buffers
+    for address in (("127.0.0.1", 0), os.path.join(tempfile.gettempdir(), "vtils_array_socket.sock")):
+        receiver = ArraySocketReceiver(address, max_nbytes=16 << 20)
+        sender = ArraySocketSender(receiver.address)
+        arrays = [np.arange(6, dtype=np.float32), np.eye(3), np.random.randint(0, 255, (1080, 1920, 3), dtype=np.uint8)]
+        thread = threading.Thread(target=lambda: [sender.send(arr) for arr in arrays])
+        thread.start()
+        for arr in arrays:
+            res = receiver.recv(out=np.empty_like(arr) if arr.nbytes > 1 << 20 else None, timeout=1.0)
+            print(f"\t{receiver.listener.family.name} seq {receiver.seq}: {res.dtype}{res.shape} match: {np.array_equal(res, arr)}")
+        thread.join()
+        sender.close()
+        receiver.close()
+
+    # Against the UDP path: one way latency and throughput over loopback
+    benchmark.run(transports=("udp", "tcp", "unix"), sizes=(64, 16384, 262144), n_messages=1000)
@@ -0,0 +1,479 @@
+import collections
+import math
+import socket
+import struct
+import time
+
+import numpy as np
+
+HELP = """
+------------------------------------------------------------------------
+Stream numpy arrays over UDP. Every datagram holds one array, prefixed by a
+header (dtype, shape, sequence number, send time, stream id), so any array
+can be sent and receivers detect loss, reordering and latency.
+Arrays larger than a datagram (images, point clouds) are split in fragments
+of the frame, and reassembled by the receiver.
+Sender:
+    - sender = ArraySender(("192.168.0.2", 5005), datagram_nbytes=1472)
+    - sender.send(arr)
+Receiver (into preallocated buffers, no allocation per datagram):
+    - receiver = ArrayReceiver(("0.0.0.0", 5005), max_nbytes=largest array, deadline=0.1)
+    - arr = receiver.recv(timeout=1.0)   # view, valid until the next recv
+    - receiver.recv(out=buffer)          # copied into buffer once complete and valid
+    - receiver.recv_latest(timeout=1.0)  # drains the socket, newest array only (slow consumers)
+    - receiver.seq, receiver.latency, receiver.lost, receiver.reordered
+    - receiver.frames_completed, receiver.frames_dropped, receiver.frame_stats
+    - receiver.stale: arrays recv_latest() skipped for a newer one
+Receive buffer (SO_RCVBUF): once it's full the kernel drops the newest
+datagrams. recv() works through the queue in order, so a large buffer means
+a slow consumer processes ever older data; recv_latest() empties it on every
+call, so it only needs to hold what arrives between two calls:
+    - receiver.rcvbuf = 2 * rate * nbytes * call period  # effective size reported back
+------------------------------------------------------------------------
+"""
+
+# Header: magic, dtype (numpy dtype.str), ndim, flags, stream id, sequence number, send time (time.time()), array nbytes
+# followed by the shape (ndim uint32), the fragment header (fragments only), then the payload (C order)
+_MAGIC = b"VTA1"
+_HEADER = struct.Struct("<4s4sBBHQdI")
+_DIM = struct.Struct("<I")
+_FRAGMENT = struct.Struct("<IIQ")  # fragment index, fragment count, byte offset in the array
+FLAG_FRAGMENT = 1
+MAX_DATAGRAM = 65507  # largest UDP payload (IPv4)
+MTU_DATAGRAM = 1472  # largest UDP payload that isn't fragmented by IP on ethernet (1500 MTU)
+MAX_NDIM = 8
+_RESTART_GAP = 1 << 16  # sequence numbers going back further: the sender restarted (new stream)
+
+
+def _restarted(seq, last_seq, stamp, last_stamp):
+    """ A sender restarted (its sequence numbers start over): seq went back far, or went back in a later message """
+    return seq < last_seq and (last_seq - seq > _RESTART_GAP or stamp > last_stamp)
+
+
+def header_nbytes(ndim, flags=0):
+    return _HEADER.size + ndim * _DIM.size + (_FRAGMENT.size if flags & FLAG_FRAGMENT else 0)
+
+
+def pack_header(arr, seq, stream=0, flags=0, stamp=None):
+    """ Header bytes describing arr (fragment header excluded) """
+    dtype = arr.dtype.str.encode("ascii")
+    assert len(dtype) <= 4 and arr.dtype.kind in "biufc", "Unsupported dtype {}".format(arr.dtype)
+    assert arr.ndim <= MAX_NDIM, "Unsupported ndim {}".format(arr.ndim)
+    stamp = time.time() if stamp is None else stamp
+    return _HEADER.pack(_MAGIC, dtype, arr.ndim, flags, stream, seq, stamp, arr.nbytes) + \
+        struct.pack(f"<{arr.ndim}I", *arr.shape)
+
+
+def unpack_header(buf):
+    """ Decode a header. Raises ValueError if buf isn't a valid array message """
+    if len(buf) < _HEADER.size:
+        raise ValueError(f"Vtils:> Message too short ({len(buf)} bytes)")
+    magic, dtype, ndim, flags, stream, seq, stamp, nbytes = _HEADER.unpack_from(buf, 0)
+    if magic != _MAGIC or ndim > MAX_NDIM or len(buf) < header_nbytes(ndim, flags):
+        raise ValueError("Vtils:> Not a vtils array message")
+    shape = struct.unpack_from(f"<{ndim}I", buf, _HEADER.size)
+    try:
+        dtype = np.dtype(dtype.rstrip(b"\0").decode("ascii"))
+    except (TypeError, ValueError):
+        raise ValueError(f"Vtils:> Invalid dtype {dtype}") from None
+    if dtype.kind not in "biufc" or nbytes != math.prod(shape) * dtype.itemsize:
+        raise ValueError(f"Vtils:> Invalid array {dtype}{shape} of {nbytes} bytes")
+    fragment = _FRAGMENT.unpack_from(buf, header_nbytes(ndim)) if flags & FLAG_FRAGMENT else (0, 1, 0)
+    return {
+        "dtype": dtype,
+        "shape": shape,
+        "flags": flags,
+        "stream": stream,
+        "seq": seq,
+        "stamp": stamp,
+        "nbytes": nbytes,
+        "header_nbytes": header_nbytes(ndim, flags),
+        "fragment": fragment,  # (index, count, offset)
+    }
+
+
+class ArraySender:
+    def __init__(self, address=("127.0.0.1", 5005), stream: int = 0, datagram_nbytes: int = MTU_DATAGRAM):
+        """ datagram_nbytes: largest datagram sent, larger arrays are fragmented (MAX_DATAGRAM on loopback) """
+        assert datagram_nbytes <= MAX_DATAGRAM, "Invalid datagram_nbytes {}".format(datagram_nbytes)
+        self.address = address
+        self.stream = stream
+        self.datagram_nbytes = datagram_nbytes
+        self.seq = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, arr):
+        """ Send arr (header and data are gathered by the kernel, no copy). Returns its sequence number """
+        arr = np.ascontiguousarray(arr)
+        self.seq += 1
+        data = memoryview(arr).cast("B")
+        if header_nbytes(arr.ndim) + arr.nbytes <= self.datagram_nbytes:
+            self.sock.sendmsg([pack_header(arr, self.seq, self.stream), data], [], 0, self.address)
+            return self.seq
+
+        # Fragments: every datagram carries the full header, so each can be placed on its own
+        header = pack_header(arr, self.seq, self.stream, flags=FLAG_FRAGMENT)
+        chunk = self.datagram_nbytes - header_nbytes(arr.ndim, FLAG_FRAGMENT)
+        count = -(-arr.nbytes // chunk)
+        for index in range(count):
+            offset = index * chunk
+            fragment = _FRAGMENT.pack(index, count, offset)
+            self.sock.sendmsg([header, fragment, data[offset:offset + chunk]], [], 0, self.address)
+        return self.seq
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _frame:
+    """ Reassembly buffer of a fragmented array """
+    def __init__(self, max_nbytes):
+        self.buffer = bytearray(max_nbytes)
+        self.received = bytearray()  # per fragment flags
+        self.header = None
+
+    def start(self, header):
+        self.header = header
+        count = header["fragment"][1]
+        if len(self.received) < count:
+            self.received = bytearray(count)
+        self.received[:count] = bytes(count)
+        self.n_received = 0
+        self.t_start = time.monotonic()
+
+    def add(self, header, data):
+        """ Copy a fragment in. Returns True once the frame is complete """
+        index, count, offset = header["fragment"]
+        if not self.received[index]:
+            self.received[index] = 1
+            self.n_received += 1
+            self.buffer[offset:offset + len(data)] = data
+        return self.n_received == count
+
+    def stats(self, completed):
+        return {"seq": self.header["seq"], "fragments": self.n_received, "count": self.header["fragment"][1],
+                "completed": completed, "duration": time.monotonic() - self.t_start}
+
+
+class _reassembler:
+    """ Reassembles fragmented arrays into n_frames preallocated frames """
+    def __init__(self, max_nbytes, n_frames=2, deadline=0.1):
+        self.max_nbytes = max_nbytes
+        self.deadline = deadline
+        self.frames = [_frame(max_nbytes) for _ in range(n_frames)]
+        self.pending = []  # frames being reassembled, oldest first
+        self.frames_completed = 0  # fragmented arrays reassembled
+        self.frames_dropped = 0  # fragmented arrays given up (deadline or evicted)
+        self.frame_stats = collections.deque(maxlen=1000)  # per fragmented frame: seq, fragments/count, completed, duration
+
+    def _drop(self, frame):
+        self.pending.remove(frame)
+        self.frames_dropped += 1
+        self.frame_stats.append(frame.stats(completed=False))
+
+    def reset(self):
+        """ Drop every pending frame (their sender restarted) """
+        for frame in list(self.pending):
+            self._drop(frame)
+
+    def drop_expired(self):
+        now = time.monotonic()
+        for frame in list(self.pending):
+            if now - frame.t_start > self.deadline:
+                self._drop(frame)
+
+    def add(self, header, data):
+        """
+        Reassemble a fragment (header["nbytes"] <= max_nbytes). Returns the completed frame, if any.
+        Raises ValueError for fragments that don't fit their array, or disagree with the frame's first fragment
+        """
+        index, count, offset = header["fragment"]
+        if not index < count <= max(header["nbytes"], 1) or offset + len(data) > header["nbytes"]:
+            raise ValueError(f"Vtils:> Invalid fragment {index}/{count} at {offset} ({len(data)} bytes)")
+        frame = next((f for f in self.pending if f.header["seq"] == header["seq"]), None)
+        if frame is not None and (frame.header["fragment"][1] != count or
+                                  any(frame.header[key] != header[key] for key in ("dtype", "shape", "nbytes"))):
+            raise ValueError(f"Vtils:> Fragment of seq {header['seq']} doesn't match the frame")
+        if frame is None:
+            if len(self.pending) == len(self.frames):
+                self._drop(self.pending[0])
+            frame = next(f for f in self.frames if f not in self.pending)
+            frame.start(header)
+            self.pending.append(frame)
+        if not frame.add(header, data):
+            return None
+        self.pending.remove(frame)
+        for older in [f for f in self.pending if f.header["seq"] < header["seq"]]:
+            self._drop(older)  # frames complete in order, older ones won't be used
+        self.frames_completed += 1
+        self.frame_stats.append(frame.stats(completed=True))
+        return frame
+
+
+class ArrayReceiver:
+    def __init__(self, address=("0.0.0.0", 5005), max_nbytes: int = MAX_DATAGRAM, deadline: float = 0.1,
+                 n_frames: int = 2, rcvbuf: int = None):
+        """
+        max_nbytes: largest array received (reassembly buffers are preallocated)
+        deadline:   seconds after its first fragment an incomplete frame is dropped
+        n_frames:   fragmented frames reassembled concurrently, the oldest is dropped to start a new one
+        rcvbuf:     socket receive buffer (SO_RCVBUF) bytes, should hold a few frames (capped by net.core.rmem_max on linux)
+        """
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if rcvbuf:
+            self.rcvbuf = rcvbuf
+        self.sock.bind(address)
+        self.address = self.sock.getsockname()
+        self._buffer = bytearray(MAX_DATAGRAM)  # preallocated, recv() returns views of it
+        self._spare_buffer = bytearray(MAX_DATAGRAM)  # recv_latest() swaps it in to keep its result
+        self._spare_frame = None  # same, for fragmented arrays (allocated on first use)
+        self.max_nbytes = max_nbytes
+        self._reassembler = _reassembler(max_nbytes, n_frames=n_frames, deadline=deadline)
+
+        # Stats of the last (valid) message, and totals
+        self.header = None
+        self.seq = 0
+        self.latency = np.nan  # seconds, sender and receiver clocks must agree
+        self.received = 0
+        self.lost = 0  # sequence gaps
+        self.reordered = 0  # late or duplicated
+        self.invalid = 0  # not vtils messages, not matching out, or too large
+        self.stale = 0  # skipped by recv_latest() for a newer array
+
+    @property
+    def rcvbuf(self):
+        """ Effective SO_RCVBUF bytes (linux doubles the requested size for its bookkeeping) """
+        return self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+
+    @rcvbuf.setter
+    def rcvbuf(self, nbytes):
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, nbytes)
+        if self.rcvbuf < nbytes:
+            print(f"Vtils:> SO_RCVBUF capped at {self.rcvbuf} bytes, {nbytes} requested (raise net.core.rmem_max)")
+
+    @property
+    def frames_completed(self):
+        return self._reassembler.frames_completed
+
+    @property
+    def frames_dropped(self):
+        return self._reassembler.frames_dropped
+
+    @property
+    def frame_stats(self):
+        return self._reassembler.frame_stats
+
+    def _track(self, header):
+        seq = header["seq"]
+        if seq > self.seq:
+            self.lost += seq - self.seq - 1
+            self.seq = seq
+        else:
+            self.reordered += 1
+        self.header = header
+        self.latency = time.time() - header["stamp"]
+        self.received += 1
+
+    def recv(self, out=None, timeout: float = None):
+        """
+        Receive the next array. Returns None on timeout (seconds, None: block).
+            - out=None: returns a view into the receive buffers, valid until the next recv()
+            - out=array: shape and dtype must match. Arrays are copied into out once complete
+              and valid, out is left untouched otherwise (invalid messages, timeouts)
+        Invalid messages are counted and skipped.
+        """
+        t_end = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if t_end is None else max(0.0, t_end - time.monotonic())
+            deadline = self._reassembler.deadline
+            if self._reassembler.pending:  # wake up in time to apply the deadline
+                remaining = deadline if remaining is None else min(remaining, deadline)
+            self.sock.settimeout(remaining)
+            try:
+                n_bytes = self.sock.recv_into(self._buffer)
+            except (socket.timeout, BlockingIOError):  # BlockingIOError: timeout=0
+                self._reassembler.drop_expired()
+                if t_end is not None and time.monotonic() >= t_end:
+                    return None
+                continue
+            buf = memoryview(self._buffer)[:n_bytes]
+            try:
+                header = unpack_header(buf)
+            except ValueError:
+                self.invalid += 1
+                continue
+            if out is not None and (header["shape"] != out.shape or header["dtype"] != out.dtype):
+                self.invalid += 1  # out got somebody else's data
+                continue
+            if self.header is not None and _restarted(header["seq"], self.seq, header["stamp"], self.header["stamp"]):
+                self.seq = 0  # new stream: neither reordered nor part of old frames
+                self._reassembler.reset()
+
+            if header["flags"] & FLAG_FRAGMENT:
+                if header["nbytes"] > self.max_nbytes:
+                    self.invalid += 1
+                    continue
+                if header["seq"] <= self.seq:
+                    continue  # part of a frame already completed or dropped
+                self._reassembler.drop_expired()
+                try:
+                    frame = self._reassembler.add(header, buf[header["header_nbytes"]:n_bytes])
+                except ValueError:
+                    self.invalid += 1
+                    continue
+                if frame is None:
+                    continue
+                self._track(frame.header)
+                data = np.frombuffer(frame.buffer, dtype=header["dtype"], count=int(np.prod(header["shape"])))
+                if out is not None:
+                    out[...] = data.reshape(header["shape"])
+                    return out
+                return data.reshape(header["shape"])
+
+            if n_bytes != header["header_nbytes"] + header["nbytes"]:
+                self.invalid += 1  # truncated
+                continue
+            self._track(header)
+            if out is not None:
+                memoryview(out).cast("B")[:] = buf[header["header_nbytes"]:]
+                return out
+            return np.frombuffer(self._buffer, dtype=header["dtype"], count=int(np.prod(header["shape"])),
+                                 offset=header["header_nbytes"]).reshape(header["shape"])
+
+    def recv_latest(self, out=None, timeout: float = None):
+        """
+        Drain the socket and return the newest array only. Waits (timeout, None: block) only
+        if nothing is queued, returns None on timeout. Older queued arrays are skipped and
+        counted in stale, so a consumer slower than the sender always works on fresh data.
+            - out=None: returns a view, valid until the next recv() / recv_latest()
+            - out=array: the newest matching array is copied into out (once per call)
+        One stream per receiver: arrays of different streams supersede each other.
+        """
+        t_end = None if timeout is None else time.monotonic() + timeout
+        latest = None
+        while True:
+            if latest is None:
+                remaining = None if t_end is None else max(0.0, t_end - time.monotonic())
+            else:
+                remaining = 0.0  # drain what's queued, don't wait for more
+            arr = self.recv(timeout=remaining)
+            if arr is None:
+                break
+            if out is not None and (arr.shape != out.shape or arr.dtype != out.dtype):
+                self.invalid += 1
+                continue
+            if latest is not None:
+                self.stale += 1
+            latest = arr
+            self._keep()
+        if latest is None or out is None:
+            return latest
+        out[...] = latest
+        return out
+
+    def _keep(self):
+        """ Swap the buffer holding the last received array for a spare one, so that the next recv leaves it intact """
+        if not self.header["flags"] & FLAG_FRAGMENT:
+            self._buffer, self._spare_buffer = self._spare_buffer, self._buffer
+            return
+        if self._spare_frame is None:
+            self._spare_frame = bytearray(self.max_nbytes)
+        frame = next(f for f in self._reassembler.frames if f.header is self.header)
+        frame.buffer, self._spare_frame = self._spare_frame, frame.buffer
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _send_frames(address, shape, n_frames, rate, datagram_nbytes):
+    sender = ArraySender(address, datagram_nbytes=datagram_nbytes)
+    frame = np.zeros(shape, dtype=np.uint8)
+    for i in range(n_frames):
+        frame[...] = i % 256
+        sender.send(frame)
+        time.sleep(1.0 / rate)
+    sender.close()
+
+
+if __name__ == '__main__':
+    import threading
+    print(HELP)
+
+    # Loopback check: mixed arrays, received as views and into preallocated buffers
+    receiver = ArrayReceiver(("127.0.0.1", 0))
+    sender = ArraySender(receiver.address)
+    arrays = [np.arange(6, dtype=np.float32), np.eye(3), np.arange(24, dtype=np.int16).reshape(2, 3, 4)]
+    for arr in arrays:
+        sender.send(arr)
+        res = receiver.recv(timeout=1.0)
+        print(f"\tseq {receiver.seq}: {res.dtype}{res.shape} match: {np.array_equal(res, arr)}")
+
+    # Throughput and latency, received into a preallocated array
+    state = np.zeros(32)
+    n_messages = 100000
+
+    def send_states():
+        for i in range(n_messages):
+            state[0] = i
+            sender.send(state)
+    out = np.empty_like(state)
+    thread = threading.Thread(target=send_states)
+    t_start = time.time()
+    thread.start()
+    latencies = []
+    while receiver.recv(out=out, timeout=0.5) is not None:
+        latencies.append(receiver.latency)
+        t_total = time.time() - t_start
+    thread.join()
+    print(f"\t{receiver.received} received, {receiver.lost} lost, {receiver.reordered} reordered, {receiver.invalid} invalid, "
+          f"{receiver.received / t_total:.0f} msg/s, latency p50 {np.median(latencies)*1e6:.1f} us")
+    sender.close()
+    receiver.close()
+
+    # Large frames: fragmented, reassembled, at camera rate
+    import multiprocessing
+    for shape, datagram_nbytes in (((480, 640, 3), MTU_DATAGRAM), ((1080, 1920, 3), MAX_DATAGRAM), ((1728, 1920, 3), MAX_DATAGRAM)):
+        nbytes = int(np.prod(shape))
+        receiver = ArrayReceiver(("127.0.0.1", 0), max_nbytes=nbytes, rcvbuf=4 * nbytes)
+        n_frames, rate = 60, 30
+        sender = multiprocessing.Process(target=_send_frames, args=(receiver.address, shape, n_frames, rate, datagram_nbytes))
+        sender.start()
+        n_valid = 0
+        while (frame := receiver.recv(timeout=1.0)) is not None:
+            n_valid += bool(np.all(frame == (receiver.seq - 1) % 256))
+        sender.join()
+        durations = [stat["duration"] for stat in receiver.frame_stats if stat["completed"]]
+        rcvbuf = receiver.rcvbuf
+        print(f"\t{nbytes / 1e6:.1f} MB frames in {datagram_nbytes} B datagrams: {receiver.frames_completed}/{n_frames} completed "
+              f"({n_valid} intact), {receiver.frames_dropped} dropped, reassembly p50 {np.median(durations)*1e3:.1f} ms "
+              f"(SO_RCVBUF {rcvbuf / 1e6:.1f} MB)")
+        receiver.close()
+
+    # Slow consumer: 1 kHz sender, 20 ms of work per array. recv() falls further behind
+    # on every call, recv_latest() always gets the array just sent
+    for mode in ("recv", "recv_latest"):
+        receiver = ArrayReceiver(("127.0.0.1", 0), rcvbuf=1 << 20)
+        sender = multiprocessing.Process(target=_send_frames, args=(receiver.address, (64,), 2000, 1000, MTU_DATAGRAM))
+        sender.start()
+        receive = getattr(receiver, mode)
+        latencies = []
+        while receive(timeout=0.5) is not None and len(latencies) < 50:
+            latencies.append(receiver.latency)
+            time.sleep(0.02)
+        sender.terminate()
+        sender.join()
+        print(f"\t{mode:<12} slow consumer: latency first {latencies[0]*1e3:.1f} ms, last {latencies[-1]*1e3:.1f} ms, "
+              f"{receiver.stale} stale skipped")
+        receiver.close()
@@ -1,19 +1,32 @@
-import socket
-import numpy as np
+import click
 
-# configs
-UDP_IP = "169.254.163.96"
-UDP_PORT = 5005
-print("UDP target IP:", UDP_IP)
-print("UDP target port:", UDP_PORT)
+from vtils.sockets.array_stream import ArrayReceiver
 
-# socket
-sock = socket.socket(socket.AF_INET, # Internet
-                     socket.SOCK_DGRAM) # UDP
-sock.bind((UDP_IP, UDP_PORT))
+DESC = """
+Print the arrays streamed to IP:PORT over UDP (see array_stream.py)\n
+    python -m vtils.sockets.client --ip 0.0.0.0 --port 5005
 
-# receive
-while True:
-    data, addr = sock.recvfrom(1024) # buffer size is 1024 bytes
-    print("received:", np.frombuffer(data, dtype=np.float32).tolist())
+With --latest, every read drains the socket and keeps the newest array only,
+so a slow consumer never processes stale packets
+"""
 
+
+@click.command(help=DESC)
+@click.option('-i', '--ip', type=str, default="169.254.163.96", help='IP to listen on')
+@click.option('-p', '--port', type=int, default=5005, help='UDP port')
+@click.option('-l', '--latest', is_flag=True, help='Skip queued arrays, newest only')
+@click.option('-b', '--rcvbuf', type=int, default=None, help='Socket receive buffer (SO_RCVBUF) bytes')
+def main(ip, port, latest, rcvbuf):
+    print("UDP target IP:", ip)
+    print("UDP target port:", port)
+    receiver = ArrayReceiver((ip, port), rcvbuf=rcvbuf)
+    print("UDP receive buffer:", receiver.rcvbuf)
+    receive = receiver.recv_latest if latest else receiver.recv
+    while True:
+        data = receive()
+        print(f"received [seq:{receiver.seq}, lost:{receiver.lost}, stale:{receiver.stale}, "
+              f"latency:{receiver.latency*1e3:.2f}ms]:", data.tolist())
+
+
+if __name__ == '__main__':
+    main()
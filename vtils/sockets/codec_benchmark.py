@@ -0,0 +1,133 @@
+DESC = """Benchmark of the array codecs (see codecs.py) on recorded streams
+
+Every codec encodes and decodes the frames of each recording, in order, and
+reports the mean bytes per frame (and compression ratio against the raw
+arrays), median encode/decode time and the largest decoding error.
+Recordings: .npy files or memmap_timeseries files (frames along the first
+axis, records are flattened to floats). Without recordings, a 1 kHz robot
+state (7 joints, positions and velocities) and a static camera are synthesized.
+
+Examples:
+    python -m vtils.sockets.codec_benchmark
+    python -m vtils.sockets.codec_benchmark -d robot_log.vtm -q 1e-4 --save codecs.json
+"""
+
+import json
+import os
+import time
+
+import click
+import numpy as np
+import numpy.lib.recfunctions as rfn
+
+from vtils.sockets.codecs import ArrayDecoder, ArrayEncoder, available_compressions
+
+
+def synthesized_recordings(n_frames=1000, seed=0):
+    """ {name: frames} of a 1 kHz robot state, and of a static camera (30 Hz) with sensor noise and a moving object """
+    rng = np.random.default_rng(seed)
+    t = np.arange(n_frames)[:, None] * 1e-3
+    freq, phase = rng.uniform(0.2, 1.0, 7), rng.uniform(0, np.pi, 7)
+    qpos = 0.5 * np.sin(2 * np.pi * freq * t + phase) + rng.normal(0, 1e-5, (n_frames, 7))
+    qvel = np.pi * freq * np.cos(2 * np.pi * freq * t + phase) + rng.normal(0, 1e-4, (n_frames, 7))
+
+    n_images = min(n_frames, 200)
+    y, x = np.mgrid[:240, :320]
+    background = np.stack([x * 255 // 320, y * 255 // 240, (x + y) % 256], axis=-1).astype(np.uint8)
+    images = np.repeat(background[None], n_images, axis=0)
+    for i, image in enumerate(images):
+        noisy = rng.random((240, 320)) < 0.02
+        image[noisy] ^= 1
+        image[100:140, 2 * i % 280:2 * i % 280 + 40] = 255
+    return {"robot_state": np.concatenate([qpos, qvel], axis=1), "static_camera": images}
+
+
+def load_recording(path, n_frames=None):
+    """ First n_frames frames of a .npy file (memory mapped) or of a memmap_timeseries file (copied) """
+    if path.endswith(".npy"):
+        return np.load(path, mmap_mode="r")[:n_frames]
+    from vtils.ipc.memmap_array import memmap_timeseries
+    series = memmap_timeseries.attach(path, readonly=True)
+    frames = series.val[:n_frames]
+    if frames.dtype.names:
+        frames = rfn.structured_to_unstructured(frames, dtype=np.float64, copy=True)
+    else:
+        frames = frames.copy()
+    series.close_link()  # views of the file are invalid once it's unmapped, frames are copies
+    return frames
+
+
+def codec_configs(quantize=1e-4):
+    """ {name: ArrayEncoder settings}: raw, compression only, XOR deltas + compression, quantized deltas """
+    configs = {"raw": dict(delta=False, compression="none"), "xor": dict(delta=True, compression="none")}
+    for compression in available_compressions()[1:]:
+        configs[compression] = dict(delta=False, compression=compression)
+        configs[f"xor+{compression}"] = dict(delta=True, compression=compression)
+    configs["quantized"] = dict(delta=True, quantize=quantize, compression="none")
+    configs["quantized+auto"] = dict(delta=True, quantize=quantize, compression="auto")
+    return configs
+
+
+def measure(frames, config, keyframe_interval=30):
+    """ Encode and decode frames in order. Returns a result dict """
+    encoder, decoder = ArrayEncoder(keyframe_interval=keyframe_interval, **config), ArrayDecoder()
+    out = np.empty_like(frames[0])
+    nbytes, encode_us, decode_us, max_error = [], [], [], 0.0
+    for frame in frames:
+        frame = np.ascontiguousarray(frame)
+        t_start = time.perf_counter()
+        message = encoder.encode(frame)
+        t_encoded = time.perf_counter()
+        decoder.decode(message, out=out)
+        t_decoded = time.perf_counter()
+        nbytes.append(message.nbytes)
+        encode_us.append((t_encoded - t_start) * 1e6)
+        decode_us.append((t_decoded - t_encoded) * 1e6)
+        max_error = max(max_error, float(np.max(np.abs(out.astype(np.float64) - frame))) if frame.size else 0.0)
+    return {
+        "frame_nbytes": int(frames[0].nbytes),
+        "bytes_per_frame": float(np.mean(nbytes)),
+        "ratio": float(frames[0].nbytes / np.mean(nbytes)),
+        "encode_us": float(np.median(encode_us)),
+        "decode_us": float(np.median(decode_us)),
+        "max_error": max_error,
+    }
+
+
+def run(recordings, quantize=1e-4, keyframe_interval=30, verbose=True):
+    """ Every codec on every recording. Returns a report dict keyed as recording/codec """
+    report = {"meta": {"compressions": available_compressions(), "quantize": quantize,
+                       "keyframe_interval": keyframe_interval}, "results": {}}
+    for name, frames in recordings.items():
+        for codec, config in codec_configs(quantize).items():
+            if config.get("quantize") and frames.dtype.kind != "f":
+                continue
+            res = measure(frames, config, keyframe_interval=keyframe_interval)
+            key = f"{name}/{codec}"
+            report["results"][key] = res
+            if verbose:
+                print(f"{key:<36} {res['bytes_per_frame']:10.0f} B/frame (x{res['ratio']:6.1f})  encode {res['encode_us']:8.1f} us"
+                      f"  decode {res['decode_us']:8.1f} us  max error {res['max_error']:.1e}")
+    return report
+
+
+@click.command(help=DESC)
+@click.option('-d', '--data', multiple=True, type=click.Path(exists=True), help='Recordings, .npy or memmap_timeseries (default: synthesized)')
+@click.option('-n', '--n_frames', type=int, default=1000, help='Frames used per recording')
+@click.option('-q', '--quantize', type=float, default=1e-4, help='Quantization step of the quantized codecs')
+@click.option('-k', '--keyframe_interval', type=int, default=30, help='Frames from one keyframe to the next')
+@click.option('-o', '--save', type=click.Path(), default=None, help='Save report as JSON')
+def main(data, n_frames, quantize, keyframe_interval, save):
+    if data:
+        recordings = {os.path.basename(path): load_recording(path, n_frames) for path in data}
+    else:
+        recordings = synthesized_recordings(n_frames)
+    report = run(recordings, quantize=quantize, keyframe_interval=keyframe_interval)
+    if save:
+        with open(save, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report saved to {save}")
+
+
+if __name__ == '__main__':
+    main()
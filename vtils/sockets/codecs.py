@@ -0,0 +1,228 @@
+import struct
+import zlib
+
+import numpy as np
+
+# Optional fast compressors, used when installed
+try:
+    import lz4.frame as _lz4
+except ImportError:
+    _lz4 = None
+try:
+    import zstandard as _zstd
+except ImportError:
+    _zstd = None
+
+HELP = """
+------------------------------------------------------------------------
+Array codecs for high volume streams: most values of a robot's state or a
+static camera's image barely change between frames, so frames are sent as
+deltas against the last keyframe, optionally quantized, then compressed.
+Keyframes are sent every keyframe_interval frames: a lost frame only costs
+itself, a lost keyframe costs the frames up to the next one.
+Encoded messages are uint8 arrays, sent with any vtils transport:
+    - encoder = ArrayEncoder(delta=True, quantize=None, compression="auto", keyframe_interval=30)
+    - sender.send(encoder.encode(arr))
+    - decoder = ArrayDecoder()  # settings are read from the messages
+    - arr = decoder.decode(receiver.recv())  # None: delta frame of a lost keyframe
+Transforms: XOR of the bytes (lossless, any dtype), or quantization of floats
+to integers of step quantize (error <= step/2, deltas fit in small integers).
+Compressions: none, zlib, lz4 (pip install lz4), zstd (pip install zstandard)
+------------------------------------------------------------------------
+"""
+
+# Message: magic, transform, flags, compression, array dtype, body dtype, ndim, quantization step, keyframe id
+# followed by the shape (ndim uint32), then the (compressed) body
+_MAGIC = b"VTC1"
+_HEADER = struct.Struct("<4sBBB4s4sBdQ")
+_DIM = struct.Struct("<I")
+RAW, XOR, QUANTIZED = 0, 1, 2  # transforms
+FLAG_DELTA = 1  # body is relative to keyframe id
+FLAG_KEYFRAME = 2  # reference of the delta frames that follow
+COMPRESSIONS = ("none", "zlib", "lz4", "zstd")  # index: compression id in messages
+MAX_NDIM = 8
+
+
+def available_compressions():
+    """ Compressions usable here (lz4 and zstd are optional) """
+    return tuple(c for c in COMPRESSIONS if (c != "lz4" or _lz4) and (c != "zstd" or _zstd))
+
+
+def _compress(compression, data, level):
+    if compression == "zlib":
+        return zlib.compress(data, 1 if level is None else level)
+    if compression == "lz4":
+        return _lz4.compress(data, compression_level=0 if level is None else level)
+    if compression == "zstd":
+        return _zstd.ZstdCompressor(level=1 if level is None else level).compress(data)
+    return data
+
+
+def _decompress(compression, data):
+    if compression == "zlib":
+        return zlib.decompress(data)
+    if compression == "lz4":
+        return _lz4.decompress(data)
+    if compression == "zstd":
+        return _zstd.ZstdDecompressor().decompress(data)
+    return data
+
+
+def _int_dtype(values):
+    """ Smallest integer dtype holding values """
+    if values.size:
+        low, high = values.min(), values.max()
+        for dtype in (np.int8, np.int16, np.int32):
+            if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max:
+                return np.dtype(dtype)
+    return np.dtype(np.int64 if values.size else np.int8)
+
+
+def _byte_planes(arr):
+    """ Bytes of arr as (elements, itemsize) """
+    return arr.reshape(-1).view(np.uint8).reshape(-1, arr.dtype.itemsize)
+
+
+class ArrayEncoder:
+    def __init__(self, delta: bool = True, quantize: float = None, compression: str = "auto", level: int = None,
+                 keyframe_interval: int = 30):
+        """
+        delta:             frames are sent relative to the last keyframe
+        quantize:          quantization step of float arrays (lossy), None: lossless
+        compression:       none, zlib, lz4, zstd or auto (the first of lz4, zstd, zlib installed)
+        level:             compression level (None: the compressor's fastest)
+        keyframe_interval: frames from one keyframe to the next (1: every frame stands alone)
+        """
+        if compression == "auto":
+            compression = next(c for c in ("lz4", "zstd", "zlib") if c in available_compressions())
+        assert compression in available_compressions(), "Unavailable compression {}".format(compression)
+        assert keyframe_interval >= 1, "Invalid keyframe_interval {}".format(keyframe_interval)
+        assert quantize is None or quantize > 0, "Invalid quantize {}".format(quantize)
+        self.delta = delta
+        self.quantize = quantize
+        self.compression = compression
+        self.level = level
+        self.keyframe_interval = keyframe_interval
+        self.frames = 0
+        self.keyframe_id = 0
+        self._reference = None  # keyframe: byte planes (XOR) or quantized values
+        self._signature = None  # dtype and shape of the keyframe
+
+    def request_keyframe(self):
+        """ Make the next frame a keyframe (e.g. when a receiver joins, or reports loss) """
+        self._signature = None
+
+    def encode(self, arr):
+        """ Encode arr. Returns the message, a uint8 array """
+        arr = np.ascontiguousarray(arr)
+        assert arr.dtype.kind in "biufc" and arr.ndim <= MAX_NDIM, "Unsupported array {}{}".format(arr.dtype, arr.shape)
+        assert self.quantize is None or arr.dtype.kind == "f", "Quantization of {} arrays".format(arr.dtype)
+        keyframe = self.delta and (self._signature != (arr.dtype, arr.shape) or
+                                   self.frames - self.keyframe_id >= self.keyframe_interval)
+        delta = self.delta and not keyframe
+        if self.quantize is not None:
+            transform = QUANTIZED
+            body = np.rint(arr / self.quantize).astype(np.int64)
+            if keyframe:
+                self._reference = body
+            elif delta:
+                body = body - self._reference
+            body = body.astype(_int_dtype(body))
+        elif self.delta:
+            # XOR leaves zeros where bytes didn't change; byte planes (all first bytes, then all
+            # second bytes...) group the unchanged high bytes of numbers into compressible runs
+            transform = XOR
+            body = _byte_planes(arr)
+            if keyframe:
+                self._reference = body.copy()
+            else:
+                body = np.bitwise_xor(body, self._reference)
+            body = body.T
+        else:
+            transform = RAW
+            body = arr
+        if keyframe:
+            self.keyframe_id = self.frames
+            self._signature = (arr.dtype, arr.shape)
+        self.frames += 1
+
+        flags = (FLAG_DELTA if delta else 0) | (FLAG_KEYFRAME if keyframe else 0)
+        header = _HEADER.pack(_MAGIC, transform, flags, COMPRESSIONS.index(self.compression), arr.dtype.str.encode("ascii"),
+                              body.dtype.str.encode("ascii"), arr.ndim, self.quantize or 0.0, self.keyframe_id) + \
+            struct.pack(f"<{arr.ndim}I", *arr.shape)
+        data = _compress(self.compression, memoryview(np.ascontiguousarray(body)).cast("B"), self.level)
+        message = np.empty(len(header) + len(data), dtype=np.uint8)
+        message[:len(header)] = np.frombuffer(header, dtype=np.uint8)
+        message[len(header):] = np.frombuffer(data, dtype=np.uint8)
+        return message
+
+
+class ArrayDecoder:
+    def __init__(self):
+        self.keyframe_id = None
+        self._reference = None
+        self.decoded = 0
+        self.undecodable = 0  # delta frames of a keyframe that wasn't received
+
+    def decode(self, message, out=None):
+        """
+        Decode a message from ArrayEncoder. Returns the array (written into out if given),
+        or None for delta frames whose keyframe wasn't received. Raises ValueError on non messages
+        """
+        message = memoryview(np.ascontiguousarray(message)).cast("B")
+        if len(message) < _HEADER.size:
+            raise ValueError(f"Vtils:> Message too short ({len(message)} bytes)")
+        magic, transform, flags, compression, dtype, body_dtype, ndim, step, keyframe_id = _HEADER.unpack_from(message)
+        if magic != _MAGIC or ndim > MAX_NDIM or len(message) < _HEADER.size + ndim * _DIM.size:
+            raise ValueError("Vtils:> Not a vtils encoded array")
+        shape = struct.unpack_from(f"<{ndim}I", message, _HEADER.size)
+        if flags & FLAG_DELTA and keyframe_id != self.keyframe_id:
+            self.undecodable += 1
+            return None
+        dtype = np.dtype(dtype.rstrip(b"\0").decode("ascii"))
+        body = np.frombuffer(_decompress(COMPRESSIONS[compression], message[_HEADER.size + ndim * _DIM.size:]),
+                             dtype=np.dtype(body_dtype.rstrip(b"\0").decode("ascii")))
+        if out is None:
+            out = np.empty(shape, dtype=dtype)
+        assert out.shape == shape and out.dtype == dtype, "Invalid out {}{}, expected {}{}".format(out.dtype, out.shape, dtype, shape)
+
+        if transform == QUANTIZED:
+            values = body.astype(np.int64)
+            if flags & FLAG_DELTA:
+                values += self._reference
+            if flags & FLAG_KEYFRAME:
+                self._reference = values
+            np.multiply(values.reshape(shape), step, out=out)
+        elif transform == XOR:
+            planes = body.reshape(dtype.itemsize, -1).T
+            out_planes = _byte_planes(out)
+            if flags & FLAG_DELTA:
+                np.bitwise_xor(planes, self._reference, out=out_planes)
+            else:
+                out_planes[...] = planes
+            if flags & FLAG_KEYFRAME:
+                self._reference = out_planes.copy()
+        else:
+            out.reshape(-1).view(np.uint8)[:] = body.view(np.uint8)
+        if flags & FLAG_KEYFRAME:
+            self.keyframe_id = keyframe_id
+        self.decoded += 1
+        return out
+
+
+if __name__ == '__main__':
+    print(HELP)
+    print(f"\tAvailable compressions: {', '.join(available_compressions())}")
+
+    # Round trips: lossless codecs are exact, quantized ones within step/2, lost keyframes are recovered
+    rng = np.random.default_rng(0)
+    frames = [np.cumsum(rng.normal(0, 1e-3, (100, 7)), axis=0)[i] for i in range(100)]
+    for config in (dict(delta=False, compression="none"), dict(delta=True), dict(delta=True, quantize=1e-5),
+                   dict(delta=False, quantize=1e-5, compression="zlib")):
+        encoder, decoder = ArrayEncoder(keyframe_interval=10, **config), ArrayDecoder()
+        messages = [encoder.encode(frame) for frame in frames]
+        errors = [np.max(np.abs(decoder.decode(message) - frame)) for message, frame in zip(messages, frames)]
+        lossy = ArrayDecoder()
+        decoded = [lossy.decode(message) for i, message in enumerate(messages) if i != 20]  # keyframe 20 lost
+        print(f"\t{str(config):<60} max error {max(errors):.1e}, {np.mean([m.nbytes for m in messages]):.0f} B/frame, "
+              f"keyframe lost: {lossy.undecodable} undecodable, {sum(d is not None for d in decoded)} decoded")
@@ -1,20 +1,33 @@
-import socket
+import time
+
+import click
 import numpy as np
-import time 
-
-# configs
-UDP_IP = "169.254.163.96"
-UDP_PORT = 5005
-print("UDP target IP:", UDP_IP)
-print("UDP target port:", UDP_PORT)
-
-# socket
-sock = socket.socket(socket.AF_INET, # Internet
-                     socket.SOCK_DGRAM) # UDP
-t_strat = time.time()
-
-# send
-while True:
-    time_now = time.time() - t_strat
-    MESSAGE = np.array([time_now], dtype=np.float32)
-    sock.sendto(MESSAGE.tobytes(), (UDP_IP, UDP_PORT))
+
+from vtils.sockets.array_stream import ArraySender
+
+DESC = """
+Stream the time since start to IP:PORT over UDP (see array_stream.py)\n
+    python -m vtils.sockets.server --ip 127.0.0.1 --port 5005 --rate 100
+"""
+
+
+@click.command(help=DESC)
+@click.option('-i', '--ip', type=str, default="169.254.163.96", help='Target IP')
+@click.option('-p', '--port', type=int, default=5005, help='UDP port')
+@click.option('-r', '--rate', type=float, default=0, help='Messages per second (0: as fast as possible)')
+def main(ip, port, rate):
+    print("UDP target IP:", ip)
+    print("UDP target port:", port)
+    sender = ArraySender((ip, port))
+    t_start = time.time()
+
+    # send
+    while True:
+        time_now = time.time() - t_start
+        sender.send(np.array([time_now], dtype=np.float32))
+        if rate:
+            time.sleep(1.0 / rate)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,289 @@
+import asyncio
+import socket
+import struct
+import time
+
+import numpy as np
+
+from vtils.sockets.array_stream import _HEADER, FLAG_FRAGMENT, MAX_DATAGRAM, _reassembler, _restarted, unpack_header
+
+HELP = """
+------------------------------------------------------------------------
+asyncio server for many concurrent array streams (see array_stream.py).
+Streams are told apart by (port, stream id): listen on one port per source,
+or on one port with a distinct ArraySender(stream=id) per source.
+Each stream decodes into its own preallocated buffer, updated in place.
+    - server = ArrayStreamServer()
+    - await server.listen(5005)
+    - server.register(5005, stream=3, shape=(7,), dtype=np.float64, callback=fn)  # optional
+    - server.latest(5005, stream=3) -> latest array (None before any message)
+    - callbacks: fn(stream) on every update, stream.value / seq / latency / lost
+    - ArrayStreamServer(latest_only=True): callbacks run once per drained batch,
+      on the newest value of each stream (stream.stale: updates skipped)
+Blocking use from scripts: ArrayStreamServer().serve(ports)
+------------------------------------------------------------------------
+"""
+
+_SEQ_STAMP = struct.Struct("<Qd")  # sequence number and send time, at byte 12 of the header
+_BATCH = 256  # datagrams drained per wake up
+
+
+class ArrayStream:
+    """ Latest value and stats of one stream """
+    def __init__(self, key, shape=None, dtype=None, max_nbytes=0, updated=None):
+        self.key = key  # (port, stream id)
+        self.value = self._raw = None
+        if shape is not None:
+            self._allocate(shape, dtype)
+        self.callbacks = []
+        self.max_nbytes = max_nbytes  # fragmented arrays up to max_nbytes are reassembled
+        self._reassembler = None
+        self.signature = None  # header bytes of single datagram messages that match value: (header nbytes, magic..ndim, nbytes..shape)
+        self._updated = updated  # latest only: streams updated in the current batch, callbacks deferred to its end
+        self._batch_updates = 0
+
+        self.seq = 0
+        self.stamp = np.nan
+        self.latency = np.nan
+        self.received = 0
+        self.lost = 0
+        self.reordered = 0
+        self.stale = 0  # latest only: updates overwritten before callbacks ran
+
+    def _allocate(self, shape, dtype):
+        self.value = np.zeros(shape, dtype=dtype)
+        self._raw = memoryview(self.value).cast("B")
+        self.signature = None
+
+    def _update(self, header, data):
+        """ Copy a decoded message in, (re)allocating the buffer on the first message or a shape change """
+        if self.value is None or self.value.shape != header["shape"] or self.value.dtype != header["dtype"]:
+            self._allocate(header["shape"], header["dtype"])
+        self._raw[:] = data
+        self._track(header["seq"], header["stamp"])
+
+    def _restart(self, seq, stamp):
+        """ Start over if the sender restarted (new stream) """
+        if _restarted(seq, self.seq, stamp, self.stamp):
+            self.seq = 0
+            if self._reassembler is not None:
+                self._reassembler.reset()
+
+    def _track(self, seq, stamp):
+        self._restart(seq, stamp)
+        if seq > self.seq:
+            self.lost += seq - self.seq - 1
+            self.seq = seq
+        else:
+            self.reordered += 1
+        self.stamp = stamp
+        self.latency = time.time() - stamp
+        self.received += 1
+        if self._updated is None:
+            self._notify()
+        elif not self._batch_updates:
+            self._updated.append(self)
+        self._batch_updates += 1
+
+    def _notify(self):
+        for callback in self.callbacks:
+            callback(self)
+
+
+class ArrayStreamServer:
+    def __init__(self, host: str = "0.0.0.0", rcvbuf: int = 4 << 20, max_nbytes: int = 1 << 20, latest_only: bool = False):
+        """
+        max_nbytes:  default largest fragmented array reassembled per stream
+        latest_only: callbacks run once per drained batch of datagrams, with the newest
+                     value of each stream, so slow callbacks don't fall behind the senders
+        """
+        self.host = host
+        self.rcvbuf = rcvbuf
+        self.max_nbytes = max_nbytes
+        self.streams = {}  # (port, stream id): ArrayStream
+        self.sockets = {}  # port: socket
+        self._buffer = bytearray(MAX_DATAGRAM)  # every datagram is received here, then copied to its stream
+        self._view = memoryview(self._buffer)
+        self.invalid = 0
+        self._on_new_stream = []
+        self._updated = [] if latest_only else None
+
+    async def listen(self, port: int = 0):
+        """ Start receiving on port (0: any free port). Returns the port """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        sock.bind((self.host, port))
+        sock.setblocking(False)
+        port = sock.getsockname()[1]
+        # A reader callback draining the socket, rather than a DatagramProtocol: asyncio's datagram
+        # transport allocates and dispatches every datagram through the event loop on its own
+        asyncio.get_running_loop().add_reader(sock, self._read_ready, sock, port)
+        self.sockets[port] = sock
+        return port
+
+    def _read_ready(self, sock, port):
+        for _ in range(_BATCH):  # bounded, so that other tasks still run under load
+            try:
+                n_bytes = sock.recv_into(self._buffer)
+            except BlockingIOError:
+                break
+            self._received(port, self._view[:n_bytes])
+        if self._updated:
+            for stream in self._updated:
+                stream.stale += stream._batch_updates - 1
+                stream._batch_updates = 0
+                stream._notify()
+            self._updated.clear()
+
+    def register(self, port, stream=0, shape=None, dtype=np.float64, callback=None, max_nbytes=None):
+        """ Declare a stream up front: preallocates its buffer and attaches a callback(stream) """
+        key = (port, stream)
+        if key not in self.streams:
+            max_nbytes = self.max_nbytes if max_nbytes is None else max_nbytes
+            self.streams[key] = ArrayStream(key, shape=shape, dtype=dtype, max_nbytes=max_nbytes, updated=self._updated)
+        if callback is not None:
+            self.streams[key].callbacks.append(callback)
+        return self.streams[key]
+
+    def on_new_stream(self, callback):
+        """ callback(stream) when an unregistered stream sends its first message """
+        self._on_new_stream.append(callback)
+
+    def latest(self, port, stream=0):
+        """ Latest array of a stream, updated in place (None before any message) """
+        stream = self.streams.get((port, stream))
+        return None if stream is None else stream.value
+
+    def _received(self, port, data):
+        if len(data) < _HEADER.size:
+            self.invalid += 1
+            return
+        stream = self.streams.get((port, data[10] | data[11] << 8))
+
+        # Fast path: single datagram with the dtype/shape of the previous message
+        if stream is not None and stream.signature is not None:
+            n_header, head, tail = stream.signature
+            if len(data) == n_header + stream.value.nbytes and data[:9] == head and data[28:n_header] == tail and not data[9]:
+                stream._raw[:] = data[n_header:]
+                stream._track(*_SEQ_STAMP.unpack_from(data, 12))
+                return
+
+        try:
+            header = unpack_header(data)
+        except ValueError:
+            self.invalid += 1
+            return
+        if stream is None:
+            stream = self.register(port, header["stream"])
+            for callback in self._on_new_stream:
+                callback(stream)
+        body = data[header["header_nbytes"]:]
+        if header["flags"] & FLAG_FRAGMENT:
+            stream._restart(header["seq"], header["stamp"])
+            if header["nbytes"] > stream.max_nbytes or header["seq"] <= stream.seq:
+                self.invalid += header["nbytes"] > stream.max_nbytes
+                return
+            if stream._reassembler is None:
+                stream._reassembler = _reassembler(stream.max_nbytes)
+            stream._reassembler.drop_expired()
+            try:
+                frame = stream._reassembler.add(header, body)
+            except ValueError:
+                self.invalid += 1
+                return
+            if frame is not None:
+                stream._update(header, memoryview(frame.buffer)[:header["nbytes"]])
+            return
+        if len(body) != header["nbytes"]:
+            self.invalid += 1
+            return
+        stream._update(header, body)
+        n_header = header["header_nbytes"]
+        stream.signature = (n_header, bytes(data[:9]), bytes(data[28:n_header]))
+
+    def close(self):
+        """ Stop receiving. Call from the event loop """
+        loop = asyncio.get_running_loop()
+        for sock in self.sockets.values():
+            loop.remove_reader(sock)
+            sock.close()
+        self.sockets.clear()
+
+    def serve(self, ports, duration: float = None):
+        """ Blocking: listen on ports, and process messages for duration seconds (None: forever) """
+        async def main():
+            try:
+                for port in ports:
+                    await self.listen(port)
+                if duration is None:
+                    await asyncio.Event().wait()
+                await asyncio.sleep(duration)
+            finally:
+                self.close()
+        asyncio.run(main())
+
+
+def _send_streams(address, n_streams, rate, duration):
+    """ n_streams sources multiplexed on one port with stream ids, each sending a 7 dof state at rate """
+    from vtils.sockets.array_stream import ArraySender
+    senders = [ArraySender(address, stream=i) for i in range(n_streams)]
+    state = np.zeros(7)
+    t_next = time.time()
+    for _ in range(int(duration * rate)):
+        for sender in senders:
+            state[0] = sender.seq
+            sender.send(state)
+        t_next += 1.0 / rate
+        time.sleep(max(0.0, t_next - time.time()))
+
+
+if __name__ == '__main__':
+    import multiprocessing
+    print(HELP)
+
+    # Load test: 50 streams at 1 kHz over loopback, one server process
+    n_streams, rate, duration = 50, 1000, 5.0
+    server = ArrayStreamServer(host="127.0.0.1", rcvbuf=8 << 20)
+    latencies = []
+    server.on_new_stream(lambda stream: stream.callbacks.append(lambda s: latencies.append(s.latency)))
+
+    async def load_test():
+        port = await server.listen(0)
+        sender = multiprocessing.Process(target=_send_streams, args=(("127.0.0.1", port), n_streams, rate, duration))
+        sender.start()
+        while sender.is_alive():
+            await asyncio.sleep(0.1)
+        await asyncio.sleep(0.2)
+        server.close()
+        return port
+    port = asyncio.run(load_test())
+
+    sent = int(duration * rate)
+    received = sum(stream.received for stream in server.streams.values())
+    lost = sum(stream.lost for stream in server.streams.values())
+    print(f"\t{len(server.streams)} streams, {received}/{sent * n_streams} received ({received / duration:.0f} msg/s), "
+          f"{lost} lost, {server.invalid} invalid, latency p50 {np.median(latencies)*1e6:.0f} us, p99 {np.percentile(latencies, 99)*1e6:.0f} us")
+    print(f"\tstream 0 latest: {server.latest(port, 0)}")
+
+    # Slow callbacks (2 ms each, 10 streams at 1 kHz): latest only keeps up by skipping stale updates
+    n_streams, duration = 10, 2.0
+    for latest_only in (False, True):
+        server = ArrayStreamServer(host="127.0.0.1", rcvbuf=8 << 20, latest_only=latest_only)
+        latencies = []
+
+        def slow_callback(stream):
+            time.sleep(2e-3)
+            latencies.append(time.time() - stream.stamp)
+        server.on_new_stream(lambda stream: stream.callbacks.append(slow_callback))
+
+        async def slow_test():
+            port = await server.listen(0)
+            sender = multiprocessing.Process(target=_send_streams, args=(("127.0.0.1", port), n_streams, rate, duration))
+            sender.start()
+            while sender.is_alive():
+                await asyncio.sleep(0.1)
+            server.close()
+        asyncio.run(slow_test())
+        stale = sum(stream.stale for stream in server.streams.values())
+        print(f"\tlatest_only={latest_only}: {len(latencies)} callbacks, {stale} stale skipped, "
+              f"latency at the end {np.median(latencies[-100:])*1e3:.1f} ms")